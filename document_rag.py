@@ -1,15 +1,26 @@
 import os
+import asyncio
+import hashlib
+import itertools
 import logging
-from typing import Dict, Any, List, Optional
+import multiprocessing
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Any, BinaryIO, List, Optional
+import numpy as np
+import faiss
 from dotenv import load_dotenv
+from haystack import Document
 from haystack.document_stores.in_memory import InMemoryDocumentStore
 from haystack.components import MemoryRetriever
 from haystack.components.embedders import SentenceTransformersTextEmbedder
-import io
-from pypdf import PdfReader
+from haystack.components.preprocessors import DocumentSplitter
+from pdf_text import iter_pdf_pages, extract_page_range, count_pdf_pages
+from semantic_cache import SemanticCache
+from tokenizer import get_encoding
 
-# Configure logging
-logging.basicConfig(level=logging.DEBUG)
+# Logging is configured by the application entrypoint
 logger = logging.getLogger(__name__)
 
 # Load environment variables
@@ -19,115 +30,532 @@ load_dotenv()
 WORKING_DIR = os.getenv("WORKING_DIR", "working_dir")
 os.makedirs(WORKING_DIR, exist_ok=True)
 
+# Semantic query cache settings
+SEMANTIC_CACHE_PATH = os.path.join(WORKING_DIR, "query_cache.db")
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.9"))
+SEMANTIC_CACHE_TTL = int(os.getenv("SEMANTIC_CACHE_TTL", "3600"))
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", "1000"))
+
+# Opened by initialize_rag and closed by finalize_rag
+semantic_cache: Optional[SemanticCache] = None
+
 # Create document store
 embedding_dim = 384
 document_store = InMemoryDocumentStore(embedding_dim=embedding_dim)
+# Ingest writes to the store from worker threads; brute-force retrieval iterates it
+_store_lock = threading.Lock()
+
+# Approximate nearest neighbour index; set USE_VEC_INDEX=false to fall back to brute force
+USE_VEC_INDEX = os.getenv("USE_VEC_INDEX", "true").lower() == "true"
+
+class VectorIndex:
+    """HNSW index over int8-quantized document embeddings for sub-linear similarity search."""
+
+    def __init__(self, dim: int, m: int = 32, ef_search: int = 64):
+        self.index = faiss.IndexHNSWSQ(dim, faiss.ScalarQuantizer.QT_8bit, m, faiss.METRIC_INNER_PRODUCT)
+        self.index.hnsw.efSearch = ef_search
+        # Embeddings are L2-normalized, so every component lies in [-1, 1]
+        bounds = np.vstack([-np.ones(dim), np.ones(dim)]).astype(np.float32)
+        self.index.train(bounds)
+        self.documents: List[Dict[str, Any]] = []
+        # HNSW cannot delete vectors, so removed documents are skipped at search time
+        self.removed: set = set()
+        # Documents are added from worker threads while searches run on the event loop
+        self._lock = threading.Lock()
+
+    def add(self, documents: List[Document]):
+        embeddings = np.asarray([doc.embedding for doc in documents], dtype=np.float32)
+        with self._lock:
+            self.index.add(embeddings)
+            self.documents.extend({"content": doc.content, "meta": doc.meta} for doc in documents)
+
+    def remove(self, ids: List[str]):
+        with self._lock:
+            self.removed.update(ids)
+
+    def search(self, embedding: np.ndarray, top_k: int) -> List[Dict[str, Any]]:
+        with self._lock:
+            scores, ids = self.index.search(embedding.reshape(1, -1), top_k + len(self.removed))
+            removed = set(self.removed)
+        return [
+            {**self.documents[i], "score": float(score)}
+            for score, i in zip(scores[0], ids[0])
+            if i != -1 and self.documents[i]["meta"].get("reference_id") not in removed
+        ][:top_k]
+
+vector_index = VectorIndex(embedding_dim)
 
 # Initialize retriever and embedder
 retriever = MemoryRetriever(document_store=document_store, top_k=3, retrieval_method="embedding")
-embedder = SentenceTransformersTextEmbedder(model="sentence-transformers/all-MiniLM-L6-v2")
+# ONNX Runtime serves MiniLM with fused kernels; EMBEDDING_MODEL_FILE can select a
+# quantized export such as onnx/model_qint8_avx2.onnx
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "onnx")
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "sentence-transformers/all-MiniLM-L6-v2")
+EMBEDDING_MODEL_FILE = os.getenv("EMBEDDING_MODEL_FILE")
+# Identifies the embedding space; cached embeddings from another model are never reused
+EMBEDDING_MODEL_ID = f"{EMBEDDING_MODEL}:{EMBEDDING_BACKEND}:{EMBEDDING_MODEL_FILE or 'default'}"
+# Texts per forward pass when embedding an upload's chunks
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "64"))
+embedder = SentenceTransformersTextEmbedder(
+    model=EMBEDDING_MODEL,
+    normalize_embeddings=True,
+    batch_size=EMBEDDING_BATCH_SIZE,
+    backend=EMBEDDING_BACKEND,
+    model_kwargs={"file_name": EMBEDDING_MODEL_FILE} if EMBEDDING_MODEL_FILE else None
+)
+
+# MiniLM only reads the first 256 tokens, so documents are chunked before embedding.
+# The splitter is built once and shared by every upload.
+CHUNK_WORDS = int(os.getenv("CHUNK_WORDS", "150"))
+CHUNK_OVERLAP_WORDS = int(os.getenv("CHUNK_OVERLAP_WORDS", "30"))
+splitter = DocumentSplitter(split_by="word", split_length=CHUNK_WORDS, split_overlap=CHUNK_OVERLAP_WORDS)
+
+# Query embedding cache settings
+EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", "10000"))
+
+class EmbeddingCache:
+    """LRU cache of query embeddings keyed by SHA-256 of the embedding model and query text."""
+
+    def __init__(self, maxsize: int = 10000):
+        self.maxsize = maxsize
+        self.entries: OrderedDict[str, np.ndarray] = OrderedDict()
+
+    async def embed(self, query: str) -> np.ndarray:
+        return (await self.embed_many([query]))[0]
+
+    async def embed_many(self, queries: List[str]) -> List[np.ndarray]:
+        """Embed queries, sending all cache misses to the embedder in a single batch"""
+        keys = [hashlib.sha256(f"{EMBEDDING_MODEL_ID}\0{query}".encode("utf-8")).hexdigest() for query in queries]
+        found: Dict[str, np.ndarray] = {}
+        missing: Dict[str, str] = {}
+        for key, query in zip(keys, queries):
+            embedding = self.entries.get(key)
+            if embedding is not None:
+                self.entries.move_to_end(key)
+                found[key] = embedding
+            else:
+                missing[key] = query
+
+        if missing:
+            result = await asyncio.to_thread(embedder.run, texts=list(missing.values()))
+            for key, embedding in zip(missing, result["embeddings"]):
+                found[key] = self.entries[key] = np.asarray(embedding, dtype=np.float32)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+        return [found[key] for key in keys]
+
+embedding_cache = EmbeddingCache(maxsize=EMBEDDING_CACHE_SIZE)
+
+async def embed_query_with_cache(query: str) -> np.ndarray:
+    """Embed a query, reusing the embedding of previously seen identical queries"""
+    return await embedding_cache.embed(query)
+
+async def embed_queries_with_cache(queries: List[str]) -> List[np.ndarray]:
+    """Embed several queries with one embedder call for those not seen before"""
+    return await embedding_cache.embed_many(queries)
+
+# Components are loaded once per process and shared by all requests
+_rag_initialized = False
+_rag_lock = asyncio.Lock()
 
 async def initialize_rag() -> Dict[str, Any]:
-    """Initialize the RAG system (dummy for compatibility)"""
+    """Initialize the RAG system once; later calls reuse the loaded components"""
+    global _rag_initialized, semantic_cache
     try:
+        if not _rag_initialized or semantic_cache is None:
+            async with _rag_lock:
+                if semantic_cache is None:
+                    semantic_cache = SemanticCache(
+                        SEMANTIC_CACHE_PATH,
+                        threshold=SEMANTIC_CACHE_THRESHOLD,
+                        ttl=SEMANTIC_CACHE_TTL,
+                        max_entries=SEMANTIC_CACHE_MAX_ENTRIES,
+                    )
+                if not _rag_initialized:
+                    logger.debug("Warming up embedder...")
+                    await asyncio.to_thread(embedder.warm_up)
+                    _rag_initialized = True
         return {"status": "success", "message": "RAG system initialized successfully"}
     except Exception as e:
         return {"status": "error", "message": str(e)}
 
-def extract_text_from_pdf(pdf_bytes: bytes) -> str:
-    """Extract text from PDF bytes"""
-    try:
-        logger.debug(f"Attempting to extract text from PDF of size {len(pdf_bytes)} bytes")
-        pdf_file = io.BytesIO(pdf_bytes)
-        reader = PdfReader(pdf_file)
-        text = ""
-        for i, page in enumerate(reader.pages):
-            page_text = page.extract_text() or ""
-            logger.debug(f"Extracted {len(page_text)} characters from page {i+1}")
-            text += page_text + "\n"
-        return text.strip()
-    except Exception as e:
-        logger.error(f"PDF extraction error: {str(e)}")
-        raise ValueError(f"Failed to extract text from PDF: {str(e)}")
+async def finalize_rag() -> None:
+    """Release resources held by the RAG system"""
+    global semantic_cache, _pdf_pool
+    query_batcher.close()
+    if semantic_cache is not None:
+        semantic_cache.close()
+        semantic_cache = None
+    if _pdf_pool is not None:
+        _pdf_pool.shutdown(wait=False, cancel_futures=True)
+        _pdf_pool = None
 
-async def process_document(content: str | bytes, metadata: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
-    """Process and add document to document store"""
-    try:
-        logger.debug(f"Processing document with metadata: {metadata}")
-
-        # Handle PDF content
-        if isinstance(content, bytes) and metadata and metadata.get("filename", "").lower().endswith(".pdf"):
-            logger.debug("Detected PDF file, extracting text...")
-            content = extract_text_from_pdf(content)
-            logger.debug(f"Extracted {len(content)} characters from PDF")
-
-        # Handle text encoding
-        elif isinstance(content, bytes):
-            logger.debug("Detected bytes content, attempting to decode...")
-            try:
-                content = content.decode('utf-8')
-            except UnicodeDecodeError:
-                try:
-                    content = content.decode('latin-1')
-                except UnicodeDecodeError:
-                    logger.error("Failed to decode content with both UTF-8 and Latin-1")
-                    return {"status": "error", "message": "Could not decode document content"}
+def query_cache_stats() -> Dict[str, Any]:
+    """Hit rates of the semantic query cache; empty until the RAG system is initialized"""
+    return semantic_cache.stats() if semantic_cache is not None else {}
+
+# PDFs with at least this many pages are extracted in parallel worker processes
+PDF_PARALLEL_MIN_PAGES = int(os.getenv("PDF_PARALLEL_MIN_PAGES", "16"))
+PDF_WORKERS = int(os.getenv("PDF_WORKERS", str(os.cpu_count() or 1)))
+_pdf_pool: Optional[ProcessPoolExecutor] = None
+
+async def extract_pdf_pages(pdf: bytes | BinaryIO) -> List[str]:
+    """Extract the text of each PDF page, spreading large PDFs across worker processes"""
+    global _pdf_pool
+    # A spooled upload may have spilled to disk, so reading it is blocking I/O
+    pdf_bytes = pdf if isinstance(pdf, bytes) else await asyncio.to_thread(pdf.read)
+    page_count = await asyncio.to_thread(count_pdf_pages, pdf_bytes)
+    if page_count < PDF_PARALLEL_MIN_PAGES or PDF_WORKERS < 2:
+        return await asyncio.to_thread(list, iter_pdf_pages(pdf_bytes))
+
+    if _pdf_pool is None:
+        # Forking this process would copy its live ONNX Runtime, FAISS and event loop threads,
+        # which can deadlock the child; forkserver workers start clean and load only pdf_text
+        _pdf_pool = ProcessPoolExecutor(max_workers=PDF_WORKERS, mp_context=multiprocessing.get_context("forkserver"))
+
+    # One contiguous page range per worker keeps the PDF bytes shipped once per worker
+    step = -(-page_count // PDF_WORKERS)
+    loop = asyncio.get_running_loop()
+    logger.debug("Extracting %d PDF pages across %d processes", page_count, PDF_WORKERS)
+    ranges = await asyncio.gather(*(
+        loop.run_in_executor(_pdf_pool, extract_page_range, pdf_bytes, start, min(start + step, page_count))
+        for start in range(0, page_count, step)
+    ))
+    return [page_text for page_range in ranges for page_text in page_range]
+
+def _decode_text(content: bytes | BinaryIO) -> str:
+    """Read and decode text content, replacing undecodable bytes"""
+    if not isinstance(content, bytes):
+        content = content.read()
+    return content.decode('utf-8', errors='replace')
+
+def _retrieve(query_embedding: np.ndarray, top_k: int) -> List[Dict[str, Any]]:
+    """Brute-force search of the document store; runs in a worker thread"""
+    with _store_lock:
+        results = retriever.run(query_embedding=query_embedding.tolist(), top_k=top_k)
+    return [
+        {"content": doc.content, "meta": doc.meta, "score": getattr(doc, "score", None)}
+        for doc in results["documents"]
+    ]
+
+def _store_documents(documents: List[Document]):
+    """Write embedded documents to the store and the vector index"""
+    with _store_lock:
+        document_store.write_documents(documents=documents, policy="OVERWRITE")
+    if USE_VEC_INDEX:
+        vector_index.add(documents)
+
+def _remove_documents(ids: List[str]):
+    """Drop documents from the store and hide them from the vector index"""
+    with _store_lock:
+        document_store.delete_documents(ids)
+    if USE_VEC_INDEX:
+        vector_index.remove(ids)
+    # Queries answered mid-ingest may have cached the removed chunks
+    semantic_cache.clear()
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+def content_digest(content: str | bytes | BinaryIO) -> str:
+    """SHA-256 of document content, hashed in 1 MiB chunks without copying the whole input"""
+    hasher = hashlib.sha256()
+    if isinstance(content, str):
+        content = content.encode('utf-8')
+    if isinstance(content, bytes):
+        view = memoryview(content)
+        for start in range(0, len(view), HASH_CHUNK_SIZE):
+            hasher.update(view[start:start + HASH_CHUNK_SIZE])
+    else:
+        position = content.tell()
+        while chunk := content.read(HASH_CHUNK_SIZE):
+            hasher.update(chunk)
+        content.seek(position)
+    return hasher.hexdigest()
+
+# Chunks embedded per step of the ingest pipeline
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", "256"))
+
+# Content hashes of ingested uploads, so duplicates are caught before parsing and embedding
+_document_ids: set = set()
+
+# Hashes being ingested right now, resolved with the ingest result
+_ingesting: Dict[str, asyncio.Future] = {}
+
+_document_numbers = itertools.count(1)
 
-        # Clean and normalize text
+def has_document(doc_id: str) -> bool:
+    """Check whether a document with this content hash has already been ingested"""
+    return doc_id in _document_ids
+
+async def _load_and_split(content: str | bytes | BinaryIO, metadata: Dict[str, Any]) -> List[Document]:
+    """Parse content into documents and split them into chunks, all off the event loop"""
+    # Handle PDF content, one document per page so pages are never concatenated
+    if not isinstance(content, str) and metadata and metadata.get("filename", "").lower().endswith(".pdf"):
+        logger.debug("Detected PDF file, extracting pages...")
+        new_docs = [
+            Document(content=page_text.strip(), meta={**metadata, "page": page})
+            for page, page_text in enumerate(await extract_pdf_pages(content), start=1)
+            if page_text.strip()
+        ]
+        logger.debug("Extracted %d non-empty pages from PDF", len(new_docs))
+
+    # Handle text encoding in a single pass, replacing undecodable bytes
+    elif not isinstance(content, str):
+        logger.debug("Detected binary content, decoding...")
+        content = await asyncio.to_thread(_decode_text, content)
+
+    # Clean and normalize text
+    if isinstance(content, str):
         content = content.strip()
-        if not content:
-            logger.error("Empty document content after processing")
-            return {"status": "error", "message": "Empty document content"}
-
-        logger.debug(f"Creating document with {len(content)} characters")
-        doc = {
-            "content": content,
-            "meta": metadata or {}
-        }
+        logger.debug("Creating document with %d characters", len(content))
+        new_docs = [Document(content=content, meta=metadata)] if content else []
+
+    if not new_docs:
+        return []
+    return (await asyncio.to_thread(splitter.run, documents=new_docs))["documents"]
+
+async def _embed_and_store(documents: List[Document]):
+    """Embed documents in batches, storing each batch while the next one is embedded"""
+    store_task = None
+    # Every batch handed to a store task, so a failed ingest leaves no partial document behind
+    storing: List[str] = []
+    try:
+        for start in range(0, len(documents), INGEST_BATCH_SIZE):
+            batch = documents[start:start + INGEST_BATCH_SIZE]
+            logger.debug("Embedding %d new documents...", len(batch))
+            embedded = (await asyncio.to_thread(embedder.run, documents=batch))["documents"]
+            if store_task is not None:
+                await store_task
+            storing.extend(doc.id for doc in embedded)
+            store_task = asyncio.create_task(asyncio.to_thread(_store_documents, embedded))
+        if store_task is not None:
+            await store_task
+    except BaseException:
+        if store_task is not None:
+            # The store runs in a thread and cannot be interrupted; let it finish before undoing it
+            await asyncio.gather(store_task, return_exceptions=True)
+        if storing:
+            logger.warning("Removing %d partially stored chunks after failed ingest", len(storing))
+            await asyncio.to_thread(_remove_documents, storing)
+        raise
+
+async def _ingest(content: str | bytes | BinaryIO, metadata: Dict[str, Any]) -> Dict[str, Any]:
+    """Split, number, embed and store one document, recording its hash once stored"""
+    new_docs = await _load_and_split(content, metadata)
+    if not new_docs:
+        logger.error("Empty document content after processing")
+        return {"status": "error", "message": "Empty document content"}
+
+    # Reference IDs ("<document>.<chunk>") double as store IDs, so citations map straight to chunks
+    doc_number = next(_document_numbers)
+    for chunk_number, doc in enumerate(new_docs, start=1):
+        doc.id = f"{doc_number}.{chunk_number}"
+        doc.meta = {**doc.meta, "reference_id": doc.id}
+
+    await _embed_and_store(new_docs)
+    _document_ids.add(metadata["doc_id"])
 
-        logger.debug("Writing document to store...")
-        document_store.write_documents([doc])
+    # Cached query results no longer reflect the document store
+    await asyncio.to_thread(semantic_cache.clear)
 
-        logger.debug("Updating embeddings...")
-        docs = document_store.filter_documents()
-        docs_with_embeddings = embedder.run(documents=docs)["documents"]
-        document_store.write_documents(documents=docs_with_embeddings, policy="OVERWRITE")
+    logger.debug("Document processing completed successfully")
+    return {"status": "success", "message": "Document processed successfully"}
 
-        logger.debug("Document processing completed successfully")
-        return {"status": "success", "message": "Document processed successfully"}
+async def process_document(content: str | bytes | BinaryIO, metadata: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """Process and add document to document store
+
+    Returns status "already_processed" when the same content was ingested before or
+    by a concurrent call that succeeded.
+    """
+    try:
+        await initialize_rag()
+        logger.debug("Processing document with metadata: %s", metadata)
+        # Callers that streamed the upload pass its hash; hash anything else here
+        if not (metadata and metadata.get("doc_id")):
+            metadata = {**(metadata or {}), "doc_id": await asyncio.to_thread(content_digest, content)}
+        doc_id = metadata["doc_id"]
+        already = {"status": "already_processed", "message": "Document already processed"}
+        if has_document(doc_id):
+            logger.debug("Document %s already ingested, skipping", doc_id)
+            return already
+
+        # A concurrent upload of the same content waits for that ingest instead of repeating it
+        pending = _ingesting.get(doc_id)
+        if pending is not None:
+            logger.debug("Document %s is already being ingested, waiting", doc_id)
+            result = await asyncio.shield(pending)
+            return already if result["status"] == "success" else result
     except Exception as e:
-        logger.error(f"Error processing document: {str(e)}", exc_info=True)
+        logger.error("Error processing document: %s", e, exc_info=True)
         return {"status": "error", "message": f"Error processing document: {str(e)}"}
 
-async def query_document(query: str, top_k: int = 3) -> Dict[str, Any]:
+    future = asyncio.get_running_loop().create_future()
+    _ingesting[doc_id] = future
+    result = {"status": "error", "message": "Document processing was cancelled"}
+    try:
+        result = await _ingest(content, metadata)
+    except Exception as e:
+        logger.error("Error processing document: %s", e, exc_info=True)
+        result = {"status": "error", "message": f"Error processing document: {str(e)}"}
+    finally:
+        # Released on failure too, so a later upload can retry
+        del _ingesting[doc_id]
+        future.set_result(result)
+    return result
+
+# Queries are trimmed client-side so oversized input never reaches the embedder or LLM
+MAX_QUERY_TOKENS = int(os.getenv("MAX_QUERY_TOKENS", "3500"))
+def trim_query(query: str, max_tokens: int = MAX_QUERY_TOKENS) -> str:
+    """Truncate a query to at most max_tokens cl100k_base tokens"""
+    enc = get_encoding("cl100k_base")
+    ids = enc.encode(query)
+    if len(ids) <= max_tokens:
+        return query
+    logger.debug("Trimming query from %d to %d tokens", len(ids), max_tokens)
+    return enc.decode(ids[:max_tokens])
+
+# Identical queries already in flight share a single retrieval
+_inflight: Dict[tuple, asyncio.Future] = {}
+
+async def query_document(query: str, top_k: int = 3, query_embedding: Optional[np.ndarray] = None) -> Dict[str, Any]:
+    """Query document store, coalescing concurrent identical queries"""
+    query = trim_query(query)
+    key = (top_k, query)
+    future = _inflight.get(key)
+    if future is None:
+        future = asyncio.ensure_future(_query_document(query, top_k, query_embedding))
+        _inflight[key] = future
+        future.add_done_callback(lambda _: _inflight.pop(key, None))
+    else:
+        logger.debug("Joining in-flight query")
+    # Shield so one cancelled caller does not cancel the shared work
+    return await asyncio.shield(future)
+
+async def _query_document(query: str, top_k: int, query_embedding: Optional[np.ndarray] = None) -> Dict[str, Any]:
     """Query document store"""
     try:
-        logger.debug(f"Processing query: {query}")
+        await initialize_rag()
+        logger.debug("Processing query: %s", query)
 
         # Check if document store is empty
-        if not document_store.filter_documents():
+        if document_store.count_documents() == 0:
             logger.debug("Document store is empty, returning empty result")
             return {
                 "status": "success",
                 "documents": []
             }
 
-        # Embed the query
-        query_embedding = embedder.run(texts=[query])["embeddings"][0]
+        # Embed the query unless the caller already did
+        if query_embedding is None:
+            query_embedding = await embed_query_with_cache(query)
+
+        # Serve near-duplicate queries from the semantic cache
+        namespace = f"{WORKING_DIR}:{EMBEDDING_MODEL_ID}:top_k={top_k}"
+        cached = await asyncio.to_thread(semantic_cache.lookup, namespace, query_embedding)
+        if cached is not None:
+            logger.debug("Returning cached documents for query")
+            return {
+                "status": "success",
+                "documents": cached
+            }
+
         # Retrieve documents
-        results = retriever.run(query_embedding=query_embedding, top_k=top_k)
-        documents = []
-        for doc in results["documents"]:
-            documents.append({
-                "content": doc.content,
-                "meta": doc.meta,
-                "score": getattr(doc, "score", None)
-            })
-        logger.debug(f"Found {len(documents)} matching documents")
+        if USE_VEC_INDEX:
+            documents = vector_index.search(query_embedding, top_k)
+        else:
+            # Scoring every stored embedding is CPU-bound, so it must not block the event loop
+            documents = await asyncio.to_thread(_retrieve, query_embedding, top_k)
+        logger.debug("Found %d matching documents", len(documents))
+        await asyncio.to_thread(semantic_cache.insert, namespace, query, query_embedding, documents)
         return {
             "status": "success",
             "documents": documents
         }
     except Exception as e:
-        logger.error(f"Error querying documents: {str(e)}", exc_info=True)
+        logger.error("Error querying documents: %s", e, exc_info=True)
         return {"status": "error", "message": str(e)}
+
+
+# Query micro-batching settings
+BATCH_WINDOW_MS = int(os.getenv("BATCH_WINDOW_MS", "10"))
+MAX_BATCH = int(os.getenv("MAX_BATCH", "16"))
+
+class QueryBatcher:
+    """Coalesces queries submitted within a short window and embeds them in one call.
+
+    Items queued with top_k=None only want the embedding, not a retrieval.
+    """
+
+    def __init__(self, window_ms: int = 10, max_batch: int = 16):
+        self.window = window_ms / 1000
+        self.max_batch = max_batch
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self._worker: Optional[asyncio.Task] = None
+        self._dispatches: set = set()
+
+    async def submit(self, query: str, top_k: int = 3) -> Dict[str, Any]:
+        """Queue a query and wait for the result of its batch"""
+        return await self._enqueue(query, top_k)
+
+    async def embed(self, query: str) -> np.ndarray:
+        """Queue a query for embedding only and wait for its batch"""
+        return await self._enqueue(query, None)
+
+    async def _enqueue(self, query: str, top_k: Optional[int]):
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.create_task(self._run())
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((query, top_k, future))
+        return await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.window
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            task = asyncio.create_task(self._dispatch(batch))
+            self._dispatches.add(task)
+            task.add_done_callback(self._dispatches.discard)
+
+    async def _dispatch(self, batch: List[tuple]):
+        logger.debug("Dispatching batch of %d queries", len(batch))
+        queries = [trim_query(query) for query, _, _ in batch]
+        try:
+            embeddings = await embed_queries_with_cache(queries)
+        except Exception as e:
+            logger.error("Error embedding query batch: %s", e, exc_info=True)
+            for _, top_k, future in batch:
+                if future.done():
+                    continue
+                if top_k is None:
+                    future.set_exception(e)
+                else:
+                    future.set_result({"status": "error", "message": str(e)})
+            return
+
+        retrievals = []
+        for query, (_, top_k, future), embedding in zip(queries, batch, embeddings):
+            if top_k is None:
+                if not future.done():
+                    future.set_result(embedding)
+            else:
+                retrievals.append((future, query_document(query, top_k, embedding)))
+        results = await asyncio.gather(*(coro for _, coro in retrievals))
+        for (future, _), result in zip(retrievals, results):
+            if not future.done():
+                future.set_result(result)
+
+    def close(self):
+        """Stop the background batching task"""
+        if self._worker is not None:
+            self._worker.cancel()
+
+query_batcher = QueryBatcher(window_ms=BATCH_WINDOW_MS, max_batch=MAX_BATCH)
@@ -1,149 +1,306 @@
 from fastapi import FastAPI, UploadFile, File, HTTPException, WebSocket, WebSocketDisconnect
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi.responses import FileResponse, ORJSONResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from fastapi.middleware.gzip import GZipMiddleware
+from pydantic import BaseModel, ConfigDict
+from anyio import to_thread
 from typing import List, Optional, Dict, Any
 import os
 import tempfile
+import hashlib
 from dotenv import load_dotenv
-from mcp import MCP
-from document_rag import initialize_rag, process_document, query_document
-import json
+from contextlib import asynccontextmanager
+from mcp import MCP, ClientSender, send_json
+from openai_client import close_clients
+from document_rag import (
+    initialize_rag, finalize_rag, process_document, has_document, query_document, query_batcher, trim_query,
+    query_cache_stats, WORKING_DIR, EMBEDDING_MODEL_ID,
+    SEMANTIC_CACHE_THRESHOLD, SEMANTIC_CACHE_TTL, SEMANTIC_CACHE_MAX_ENTRIES
+)
+from semantic_cache import SemanticCache, ExactCache
 import asyncio
+from operator import itemgetter
 import uvicorn
 import logging
 
 # Configure logging
 logging.basicConfig(
-    level=logging.DEBUG,
+    level=os.getenv("LOG_LEVEL", "INFO").upper(),
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 )
 logger = logging.getLogger(__name__)
 
 load_dotenv()
 
-app = FastAPI()
-
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Create per-process state on startup and release it on shutdown."""
+    to_thread.current_default_thread_limiter().total_tokens = THREAD_POOL_SIZE
+    if not os.getenv("OPENAI_API_KEY"):
+        raise Exception("OPENAI_API_KEY environment variable is not set")
+    try:
+        logger.debug("Initializing MCP and LightRAG")
+        app.state.mcp = MCP()
+        logger.info("MCP initialized successfully")
+    except Exception as e:
+        logger.error("Error initializing MCP: %s", e)
+        raise
+    app.state.rag = await initialize_rag()
+    # Responses to near-duplicate messages are served from a semantic cache
+    app.state.response_cache = SemanticCache(
+        os.path.join(WORKING_DIR, "response_cache.db"),
+        threshold=SEMANTIC_CACHE_THRESHOLD,
+        ttl=SEMANTIC_CACHE_TTL,
+        max_entries=SEMANTIC_CACHE_MAX_ENTRIES,
+    )
+    # Verbatim repeats are answered from memory without embedding the message
+    app.state.exact_cache = ExactCache(max_entries=EXACT_CACHE_SIZE, ttl=SEMANTIC_CACHE_TTL)
+    try:
+        yield
+    finally:
+        await finalize_rag()
+        app.state.response_cache.close()
+        await close_clients()
+
+app = FastAPI(default_response_class=ORJSONResponse, lifespan=lifespan)
+
+# Compress larger JSON bodies; small responses are not worth the CPU
+app.add_middleware(GZipMiddleware, minimum_size=1024, compresslevel=5)
+
+# The bundled frontend is same-origin; list other frontends in CORS_ORIGINS (comma-separated)
+CORS_ORIGINS = [origin.strip() for origin in os.getenv("CORS_ORIGINS", "").split(",") if origin.strip()]
+if CORS_ORIGINS:
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=CORS_ORIGINS,
+        allow_credentials=True,
+        allow_methods=["GET", "POST"],
+        allow_headers=["Content-Type", "Authorization"],
+        max_age=86400,  # Let browsers cache preflight responses for a day
+    )
 
 
 # Mount static files
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
-# Initialize MCP and LightRAG
-try:
-    logger.debug("Initializing MCP and LightRAG")
-    mcp = MCP()
-    app.state.rag = None  # Will be initialized in startup event
-    app.state.has_documents = False  # Track if documents are uploaded
-    logger.info("MCP initialized successfully")
-except Exception as e:
-    logger.error(f"Error initializing MCP: {str(e)}")
-    raise
-
-# Create temp directory for uploaded files
-os.makedirs("temp", exist_ok=True)
+# MCP, RAG and the response cache are created per worker process in the lifespan handler
+app.state.mcp = None
+app.state.rag = None
+app.state.response_cache = None
+app.state.exact_cache = None
+app.state.doc_count = 0  # Number of documents ingested by this process
+
+# Uploads are read in chunks and spill to disk beyond this size
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+UPLOAD_SPOOL_SIZE = 8 * 1024 * 1024
+EXACT_CACHE_SIZE = int(os.getenv("EXACT_CACHE_SIZE", "4096"))
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(100 * 1024 * 1024)))
+BROADCAST_LOG_SAMPLE = 1000
+# Threads available to sync endpoints and Starlette's upload file I/O; anyio defaults to 40
+THREAD_POOL_SIZE = int(os.getenv("THREAD_POOL_SIZE", "200"))
+ALLOWED_EXTENSIONS = frozenset({'.pdf', '.txt', '.docx', '.doc', '.md'})
+ALLOWED_EXT_STR = ', '.join(sorted(ALLOWED_EXTENSIONS))
 
 class MessageRequest(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+
+    message: str
+    settings: Dict[str, Any]
+    useRag: bool = False
+    documents: List[str] = []
+
+class WSInboundMessage(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+
     message: str
-    settings: dict
     useRag: bool = False
 
 # WebSocket connection manager
 class ConnectionManager:
     def __init__(self):
         self.active_connections: List[WebSocket] = []
+        self.broadcasts = 0
 
     async def connect(self, websocket: WebSocket):
         await websocket.accept()
         self.active_connections.append(websocket)
-        logger.debug(f"New WebSocket connection. Total connections: {len(self.active_connections)}")
+        logger.debug("New WebSocket connection. Total connections: %d", len(self.active_connections))
 
     def disconnect(self, websocket: WebSocket):
-        self.active_connections.remove(websocket)
-        logger.debug(f"WebSocket disconnected. Remaining connections: {len(self.active_connections)}")
+        if websocket in self.active_connections:
+            self.active_connections.remove(websocket)
+        logger.debug("WebSocket disconnected. Remaining connections: %d", len(self.active_connections))
 
     async def broadcast(self, message: str):
-        for connection in self.active_connections:
-            await connection.send_text(message)
-        logger.debug(f"Broadcasted message to {len(self.active_connections)} connections")
+        # Send concurrently so one slow client does not delay the others
+        connections = list(self.active_connections)
+        results = await asyncio.gather(
+            *(connection.send_text(message) for connection in connections),
+            return_exceptions=True
+        )
+        for connection, result in zip(connections, results):
+            if isinstance(result, Exception):
+                logger.debug("Dropping WebSocket after failed send: %s", result)
+                self.disconnect(connection)
+        # Sample the per-broadcast log line to keep it off the hot path
+        self.broadcasts += 1
+        if self.broadcasts % BROADCAST_LOG_SAMPLE == 0:
+            logger.debug("Broadcasted %d messages, now to %d connections", self.broadcasts, len(self.active_connections))
 
 manager = ConnectionManager()
 
-@app.on_event("startup")
-async def startup_event():
-    if not os.getenv("OPENAI_API_KEY"):
-        raise Exception("OPENAI_API_KEY environment variable is not set")
-    app.state.rag = await initialize_rag()
+def response_namespace(use_rag: bool) -> str:
+    """Answers grounded in documents are cached apart from plain chat answers, per embedding model."""
+    return f"{'rag' if use_rag else 'chat'}:{EMBEDDING_MODEL_ID}"
+
+_content_and_meta = itemgetter("content", "meta")
+
+def build_context(documents: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Map retrieved documents to the context items MCP formats into the prompt."""
+    return [{"content": content, "metadata": meta} for content, meta in map(_content_and_meta, documents)]
+
+async def retrieve_context(message: str, embedding=None) -> Optional[List[Dict[str, Any]]]:
+    """Fetch RAG context for a message; retrieval failures fall back to no context."""
+    try:
+        # A message already embedded for the response cache skips the embedding batcher
+        if embedding is not None:
+            rag_response = await query_document(message, query_embedding=embedding)
+        else:
+            rag_response = await query_batcher.submit(message)
+        if rag_response["status"] == "success" and rag_response.get("documents"):
+            context = build_context(rag_response["documents"])
+            logger.debug("Retrieved RAG context with %d documents", len(context))
+            return context
+    except Exception as e:
+        logger.error("Error getting context from RAG: %s", e)
+    return None
+
+async def lookup_response(message: str, use_rag: bool):
+    """Look a message up by exact text, then by embedding; tool commands are never cached."""
+    if app.state.mcp.tools.extract_command(message):
+        return None, None
+    cached = app.state.exact_cache.get(response_namespace(use_rag), message)
+    if cached is not None:
+        return None, cached
+    # Batched with concurrent messages so N chats cost one embedder call, not N
+    try:
+        embedding = await query_batcher.embed(message)
+    except Exception as e:
+        # A cache is an optimisation; without an embedding the message is answered uncached
+        logger.error("Error embedding message for the response cache: %s", e)
+        return None, None
+    cached = await asyncio.to_thread(app.state.response_cache.lookup, response_namespace(use_rag), embedding)
+    if cached is not None:
+        app.state.exact_cache.put(response_namespace(use_rag), message, cached)
+    return embedding, cached
+
+async def store_response(message: str, use_rag: bool, embedding, result: Dict[str, Any]):
+    """Remember a response in both the exact and the semantic cache."""
+    app.state.exact_cache.put(response_namespace(use_rag), message, result)
+    await asyncio.to_thread(app.state.response_cache.insert, response_namespace(use_rag), message, embedding, result)
 
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
     """WebSocket endpoint for streaming responses."""
     await websocket.accept()
+    sender = ClientSender(websocket)
     try:
         while True:
-            data = await websocket.receive_json()
-            message = data.get("message", "")
-            use_rag = data.get("useRag", False)  # Get RAG flag from request
-
-            logger.debug(f"WebSocket message received: {message[:100]}...")
+            data = WSInboundMessage.model_validate_json(await websocket.receive_text())
+            message = trim_query(data.message)
+            # RAG is skipped entirely until a document has been uploaded
+            use_rag = data.useRag and app.state.doc_count > 0
+
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("WebSocket message received: %s...", message[:100])
+
+            # Tool commands run the tool, streaming list results item by item
+            command = app.state.mcp.tools.extract_command(message)
+            if command:
+                await app.state.mcp.process_command_stream(command, message, sender)
+                continue
+
+            # Answer near-duplicate messages from the response cache
+            embedding, cached = await lookup_response(message, use_rag)
+            if cached is not None:
+                logger.debug("Serving cached response")
+                await send_json(sender, {
+                    "type": "stream",
+                    "content": cached["response"]
+                })
+                if cached.get("references"):
+                    await send_json(sender, {
+                        "type": "references",
+                        "references": cached["references"]
+                    })
+                continue
 
             # Get context from RAG if documents are uploaded and RAG is requested
-            context = None
-            if use_rag and app.state.has_documents:
-                try:
-                    rag_response = await query_document(message)
-                    if rag_response["status"] == "success" and rag_response.get("documents"):
-                        context = [{"content": doc["content"], "metadata": doc["meta"]} for doc in rag_response["documents"]]
-                        logger.debug(f"Retrieved RAG context with {len(context)} documents")
-                except Exception as e:
-                    logger.error(f"Error getting context from RAG: {str(e)}")
+            context = await retrieve_context(message, embedding) if use_rag else None
 
             # Process message with context
-            await mcp.process_message_stream(message, context, websocket)
+            result = await app.state.mcp.process_message_stream(message, context, sender)
+            if embedding is not None:
+                await store_response(message, use_rag, embedding, result)
 
     except WebSocketDisconnect:
         logger.info("WebSocket disconnected")
     except Exception as e:
-        logger.error(f"WebSocket error: {str(e)}")
+        logger.error("WebSocket error: %s", e)
         try:
-            await websocket.send_json({
+            await send_json(sender, {
                 "type": "error",
                 "content": str(e)
             })
         except:
             pass
+    finally:
+        await sender.close()
 
 @app.post("/send_message")
 async def send_message(message: MessageRequest):
     """Send a message and get a response."""
     try:
-        logger.debug(f"Processing message: {message.message}")
+        logger.debug("Processing message: %s", message.message)
+        message.message = trim_query(message.message)
+
+        # Answer near-duplicate messages from the response cache
+        use_rag = message.useRag and app.state.doc_count > 0
+        embedding, cached = await lookup_response(message.message, use_rag)
+        if cached is not None:
+            logger.debug("Serving cached response")
+            return ORJSONResponse(
+                content={
+                    "content": cached.get("content", ""),
+                    "error": None
+                }
+            )
 
-        # Get context from RAG if documents are uploaded
-        context = None
-        if message.useRag and app.state.has_documents:
-            try:
-                rag_response = await query_document(message.message)
-                if rag_response["status"] == "success" and rag_response.get("documents"):
-                    # Format context as list of dicts for MCP
-                    context = [{"content": doc["content"], "metadata": doc["meta"]} for doc in rag_response["documents"]]
-                    logger.debug(f"Retrieved RAG context with {len(context)} documents")
-            except Exception as e:
-                logger.error(f"Error getting context from RAG: {str(e)}")
+        # Retrieve RAG context while MCP routes the message; neither depends on the other
+        if use_rag:
+            prepared, context = await asyncio.gather(
+                app.state.mcp.prepare_prompt(message.message),
+                retrieve_context(message.message, embedding)
+            )
+        else:
+            prepared, context = await app.state.mcp.prepare_prompt(message.message), None
 
         # Process message with context
-        result = await mcp.process_message(message.message, context)
+        result = await app.state.mcp.process_prepared(prepared, context)
 
         if "error" in result:
-            logger.error(f"Error processing message: {result['error']}")
-            return JSONResponse(
+            logger.error("Error processing message: %s", result['error'])
+            return ORJSONResponse(
                 status_code=500,
                 content={"error": result["error"], "content": ""}
             )
 
+        if embedding is not None:
+            await store_response(message.message, use_rag, embedding, result)
+
         # Ensure we always return a properly formatted response
-        return JSONResponse(
+        return ORJSONResponse(
             content={
                 "content": result.get("content", ""),
                 "error": None
@@ -151,8 +308,8 @@ async def send_message(message: MessageRequest):
         )
 
     except Exception as e:
-        logger.error(f"Error in send_message: {str(e)}")
-        return JSONResponse(
+        logger.error("Error in send_message: %s", e)
+        return ORJSONResponse(
             status_code=500,
             content={"error": str(e), "content": ""}
         )
@@ -161,7 +318,7 @@ async def send_message(message: MessageRequest):
 async def upload_document(file: UploadFile = File(...)):
     """Upload and process a document."""
     try:
-        logger.debug(f"Processing document upload: {file.filename}")
+        logger.debug("Processing document upload: %s", file.filename)
 
         # Validate file
         if not file.filename:
@@ -169,58 +326,106 @@ async def upload_document(file: UploadFile = File(...)):
             raise HTTPException(status_code=400, detail="No filename provided")
 
         # Check file extension
-        allowed_extensions = {'.pdf', '.txt', '.docx', '.doc', '.md'}
-        file_ext = os.path.splitext(file.filename)[1].lower()
-        if file_ext not in allowed_extensions:
-            logger.error(f"Unsupported file type: {file_ext}")
+        file_ext = '.' + file.filename.rpartition('.')[2].lower()
+        if file_ext not in ALLOWED_EXTENSIONS:
+            logger.error("Unsupported file type: %s", file_ext)
             raise HTTPException(
                 status_code=400,
-                detail=f"Unsupported file type. Allowed types: {', '.join(allowed_extensions)}"
+                detail=f"Unsupported file type. Allowed types: {ALLOWED_EXT_STR}"
             )
 
-        # Read file contents
-        try:
-            contents = await file.read()
-            if not contents:
-                logger.error("Empty file uploaded")
-                raise HTTPException(status_code=400, detail="File is empty")
-        except Exception as e:
-            logger.error(f"Error reading file: {str(e)}")
-            raise HTTPException(status_code=400, detail="Error reading file")
-
-        # Process document with LightRAG
-        try:
-            metadata = {"filename": file.filename}
-            result = await process_document(contents, metadata)
-
-            if result["status"] == "error":
+        # Stream file contents into a spooled buffer that only touches disk for large files
+        with tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_SIZE) as contents:
+            hasher = hashlib.sha256()
+            try:
+                while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                    contents.write(chunk)
+                    hasher.update(chunk)
+                    if contents.tell() > MAX_UPLOAD_BYTES:
+                        logger.error("Upload exceeds %d bytes: %s", MAX_UPLOAD_BYTES, file.filename)
+                        raise HTTPException(status_code=413, detail="File too large")
+                if not contents.tell():
+                    logger.error("Empty file uploaded")
+                    raise HTTPException(status_code=400, detail="File is empty")
+                contents.seek(0)
+            except HTTPException:
+                raise
+            except Exception as e:
+                logger.error("Error reading file: %s", e)
+                raise HTTPException(status_code=400, detail="Error reading file")
+
+            # Skip parsing and embedding entirely for content that was already ingested
+            doc_id = hasher.hexdigest()
+            if has_document(doc_id):
+                logger.info("Document %s already processed", file.filename)
+                return ORJSONResponse(content={
+                    "message": f"Document {file.filename} already processed",
+                    "status": "already_processed"
+                })
+
+            # Process document with LightRAG
+            try:
+                metadata = {"filename": file.filename, "doc_id": doc_id}
+                result = await process_document(contents, metadata)
+
+                if result["status"] == "error":
+                    raise HTTPException(
+                        status_code=500,
+                        detail=f"Error processing document: {result['message']}"
+                    )
+                if result["status"] == "already_processed":
+                    # A concurrent upload of the same file ingested it first
+                    logger.info("Document %s already processed", file.filename)
+                    return ORJSONResponse(content={
+                        "message": f"Document {file.filename} already processed",
+                        "status": "already_processed"
+                    })
+
+                app.state.doc_count += 1
+                # Cached document-grounded answers may no longer match the corpus
+                app.state.exact_cache.clear(response_namespace(True))
+                await asyncio.to_thread(app.state.response_cache.clear, response_namespace(True))
+                logger.info("Document %s processed successfully", file.filename)
+                return ORJSONResponse(content={
+                    "message": f"Document {file.filename} processed successfully",
+                    "status": "success"
+                })
+            except Exception as e:
+                logger.error("Error processing document: %s", e)
                 raise HTTPException(
                     status_code=500,
-                    detail=f"Error processing document: {result['message']}"
+                    detail=f"Error processing document: {str(e)}"
                 )
 
-            app.state.has_documents = True
-            logger.info(f"Document {file.filename} processed successfully")
-            return JSONResponse(content={
-                "message": f"Document {file.filename} processed successfully",
-                "status": "success"
-            })
-        except Exception as e:
-            logger.error(f"Error processing document: {str(e)}")
-            raise HTTPException(
-                status_code=500,
-                detail=f"Error processing document: {str(e)}"
-            )
-
     except HTTPException:
         raise
     except Exception as e:
-        logger.error(f"Unexpected error in upload_document: {str(e)}")
+        logger.error("Unexpected error in upload_document: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/cache/stats")
+async def cache_stats():
+    """Report hit rates of the response and RAG query caches."""
+    return {
+        "exact": app.state.exact_cache.stats(),
+        "responses": await asyncio.to_thread(app.state.response_cache.stats),
+        "queries": await asyncio.to_thread(query_cache_stats)
+    }
+
 @app.get("/")
 async def read_root():
     return FileResponse("static/index.html")
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # Documents live in per-process memory, so more than one worker only suits
+    # deployments that do not rely on uploaded documents
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=8000,
+        loop="uvloop",
+        http="httptools",
+        ws_per_message_deflate=True,
+        workers=int(os.getenv("WEB_CONCURRENCY", "1")),
+        log_level="info"
+    )
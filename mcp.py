@@ -1,21 +1,141 @@
 import os
 from dotenv import load_dotenv
-from typing import Dict, Any, Generator, Optional, List
+from typing import Dict, Any, Generator, Optional, List, Tuple
 from tools import OpenAITools
-from openai import OpenAI
+from openai_client import get_async_client, rate_limiter, estimate_tokens
 import json
+import orjson
 import asyncio
 from fastapi import WebSocket
 import re
+import math
+import time
 import logging
+from functools import lru_cache
 
-# Configure logging
-logging.basicConfig(
-    level=logging.DEBUG,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
+# Logging is configured by the application entrypoint
 logger = logging.getLogger(__name__)
 
+# Streamed tokens are sent in batches that start small for a fast first frame and grow
+STREAM_BATCH_SIZE = int(os.getenv("STREAM_BATCH_SIZE", "50"))
+STREAM_MIN_BATCH_SIZE = int(os.getenv("STREAM_MIN_BATCH_SIZE", "1"))
+STREAM_BATCH_GROWTH_FACTOR = float(os.getenv("STREAM_BATCH_GROWTH_FACTOR", "2"))
+STREAM_FLUSH_MS = int(os.getenv("STREAM_FLUSH_MS", "30"))
+# A batch is also flushed once it holds this many characters, however few tokens
+STREAM_FLUSH_CHARS = int(os.getenv("STREAM_FLUSH_CHARS", "256"))
+CHUNK_CACHE_SIZE = int(os.getenv("CHUNK_CACHE_SIZE", "1024"))
+CONTEXT_CACHE_SIZE = int(os.getenv("CONTEXT_CACHE_SIZE", "256"))
+# Prompts are kept under this share of the model's context window, completion budget included
+CONTEXT_WINDOW_TOKENS = int(os.getenv("CONTEXT_WINDOW_TOKENS", "8192"))
+CONTEXT_BUDGET_RATIO = float(os.getenv("CONTEXT_BUDGET_RATIO", "0.8"))
+
+# Citations look like [1.2]; an unclosed "[" longer than this is not a citation
+_REF_RE = re.compile(r'\[([\d.]+)\]')
+REF_TAIL_MAX = 32
+
+SEND_QUEUE_SIZE = int(os.getenv("SEND_QUEUE_SIZE", "256"))
+SEND_MERGE_MAX = int(os.getenv("SEND_MERGE_MAX", "4"))
+
+class ClientSender:
+    """Per-client outbound queue drained by a single task, merging adjacent stream frames."""
+
+    def __init__(self, websocket: WebSocket, maxsize: int = SEND_QUEUE_SIZE):
+        self.websocket = websocket
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=maxsize)
+        self.error: Optional[Exception] = None
+        self.task = asyncio.create_task(self._drain())
+
+    async def put(self, payload: Dict[str, Any]):
+        if self.error is not None:
+            raise self.error
+        await self.queue.put(payload)
+
+    async def _drain(self):
+        while True:
+            batch = [await self.queue.get()]
+            while len(batch) < SEND_MERGE_MAX and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            try:
+                if self.error is None:
+                    for payload in self._merge(batch):
+                        await self.websocket.send_text(orjson.dumps(payload).decode())
+            except Exception as e:
+                # Keep consuming so producers never block on a dead connection
+                self.error = e
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    @staticmethod
+    def _merge(batch: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        merged: List[Dict[str, Any]] = []
+        for payload in batch:
+            if merged and payload.get("type") == "stream" and merged[-1].get("type") == "stream":
+                merged[-1] = {"type": "stream", "content": merged[-1]["content"] + payload["content"]}
+            else:
+                merged.append(payload)
+        return merged
+
+    async def close(self):
+        """Flush queued frames, then stop the drain task."""
+        try:
+            await self.queue.join()
+        finally:
+            self.task.cancel()
+
+async def send_json(websocket, payload: Dict[str, Any]):
+    """Send a payload as a JSON text frame, encoded with orjson."""
+    if isinstance(websocket, ClientSender):
+        await websocket.put(payload)
+        return
+    await websocket.send_text(orjson.dumps(payload).decode())
+
+# Sent byte-identical on every call so providers can cache the prompt prefix;
+# per-request content (context, question) always follows it
+STATIC_SYSTEM = """You are a helpful AI assistant. Provide clear, concise, and accurate responses. You can:
+1. Answer general questions based on your knowledge
+2. Use provided context to answer questions about specific documents
+
+When using context:
+- If the answer is in the context, cite sources using reference IDs in square brackets (e.g., [1.2])
+- If the answer isn't in the context, provide a natural response based on your knowledge
+- If no context is provided, answer based on your general knowledge
+- Always maintain a natural conversation flow
+- Use context7 format for citations when available"""
+
+@lru_cache(maxsize=CHUNK_CACHE_SIZE)
+def format_chunk(ref_id: str, source: str, page: str, content: str) -> str:
+    """Format one retrieved chunk; repeated chunks reuse the same string."""
+    return f"[{ref_id}] From {source} (Page {page}):\n{content}"
+
+@lru_cache(maxsize=CONTEXT_CACHE_SIZE)
+def format_chunks(chunks: Tuple[Tuple[str, str, str, str], ...]) -> Tuple[str, ...]:
+    """Format a retrieved set sorted by reference ID; the same set reuses the same strings."""
+    return tuple(format_chunk(*chunk) for chunk in sorted(chunks, key=lambda chunk: chunk[0]))
+
+# Tool command -> formatter for its result, looked up once instead of a comparison chain
+RESPONSE_FORMATTERS = {
+    "analyze": lambda result: f"🔍 **Analysis:**\n{result['analysis']}",
+    "translate": lambda result: f"🌐 **Translation:**\n{result['translation']}",
+    "summarize": lambda result: f"📝 **Summary:**\n{result['summary']}",
+    "classify": lambda result: f"🏷️ **Classification:**\n{result['classification']}",
+    "questions": lambda result: "❓ **Questions:**\n" + "\n".join(f"• {q}" for q in result['questions']),
+    "keywords": lambda result: "🔑 **Keywords:**\n" + ", ".join(result['keywords']),
+    "code": lambda result: result['code'],
+    "entities": lambda result: "👥 **Entities:**\n" + "\n".join(f"• {e}" for e in result['entities']),
+    "bundle": lambda result: "\n\n".join(
+        RESPONSE_FORMATTERS[command](result) for command in ("analyze", "summarize", "keywords", "questions")
+    ),
+}
+
+# Header, item template and separator for tools streamed item by item; the joined
+# output matches RESPONSE_FORMATTERS for the same items
+STREAM_FORMATS = {
+    "entities": ("👥 **Entities:**\n", "• {}", "\n"),
+    "questions": ("❓ **Questions:**\n", "• {}", "\n"),
+    "keywords": ("🔑 **Keywords:**\n", "{}", ", "),
+}
+
 class MCP:
     def __init__(self):
         logger.debug("Initializing MCP system")
@@ -25,127 +145,211 @@ class MCP:
             if not self.api_key:
                 raise ValueError("OPENAI_API_KEY environment variable is not set")
 
-            self.client = OpenAI(api_key=self.api_key)
+            # Share one async client so chat and tool calls reuse the same keep-alive connections
+            self.client = get_async_client(self.api_key)
             self.model = os.getenv("OPENAI_MODEL", "gpt-4")
-            self.tools = OpenAITools(api_key=self.api_key)
+            self.tools = OpenAITools(api_key=self.api_key, client=self.client)
             self.temperature = 0.7
             self.max_tokens = 2000
             logger.info("MCP system initialized successfully")
         except Exception as e:
-            logger.error(f"Error initializing MCP system: {str(e)}")
+            logger.error("Error initializing MCP system: %s", e)
             raise
 
-    def _format_context(self, context: List[Dict[str, Any]]) -> str:
-        """Format context for the prompt."""
-        formatted = []
+    def _format_context(self, context: List[Dict[str, Any]]) -> Tuple[str, ...]:
+        """Format each context item on its own, ordered by reference ID so equal retrievals format identically."""
+        return format_chunks(tuple(
+            (
+                str(item.get('metadata', {}).get('reference_id', 'N/A')),
+                str(item.get('metadata', {}).get('source', 'Unknown')),
+                str(item.get('metadata', {}).get('page', 'N/A')),
+                item.get('content', '')
+            )
+            for item in context
+        ))
+
+    def _compact_context(self, question: str, context: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Drop repeated chunks, then any chunk that no longer fits the token budget."""
+        budget = int(CONTEXT_WINDOW_TOKENS * CONTEXT_BUDGET_RATIO) - self.max_tokens
+        budget -= (len(STATIC_SYSTEM) + len(question)) // 4
+        seen = set()
+        kept = []
+        # Context arrives best match first, so better chunks claim the budget; a smaller,
+        # lower-ranked chunk may still fit after a large one is skipped
         for item in context:
-            ref_id = item.get('metadata', {}).get('reference_id', 'N/A')
-            source = item.get('metadata', {}).get('source', 'Unknown')
-            page = item.get('metadata', {}).get('page', 'N/A')
             content = item.get('content', '')
-            formatted.append(f"[{ref_id}] From {source} (Page {page}):\n{content}")
-        return "\n\n".join(formatted)
+            if content in seen:
+                continue
+            cost = len(content) // 4
+            if cost > budget:
+                continue
+            seen.add(content)
+            budget -= cost
+            kept.append(item)
+        if len(kept) < len(context):
+            logger.debug("Compacted context from %d to %d chunks", len(context), len(kept))
+        return kept
 
-    def _create_qa_prompt(self, question: str, context: Optional[List[Dict[str, Any]]] = None) -> str:
-        """Create a prompt for Q&A."""
-        base_prompt = """You are a helpful AI assistant. You can:
-1. Answer general questions based on your knowledge
-2. Use provided context to answer questions about specific documents
-
-When using context:
-- If the answer is in the context, cite sources using reference IDs in square brackets (e.g., [1.2])
-- If the answer isn't in the context, provide a natural response based on your knowledge
-- If no context is provided, answer based on your general knowledge
-- Always maintain a natural conversation flow
-- Use context7 format for citations when available
-
-Question: {question}"""
-
-        if context and len(context) > 0:
-            formatted_context = self._format_context(context)
-            return f"{base_prompt}\n\nContext:\n{formatted_context}"
-        return base_prompt.format(question=question)
+    def _build_messages(self, question: str, context: Optional[List[Dict[str, Any]]] = None) -> List[Dict[str, str]]:
+        """Build chat messages with the static instructions first and the question last."""
+        messages = [{"role": "system", "content": STATIC_SYSTEM}]
+        if context:
+            context = self._compact_context(question, context)
+            # One message per chunk keeps each chunk's text stable wherever it lands in the prompt
+            messages.extend({"role": "system", "content": chunk} for chunk in self._format_context(context))
+        messages.append({"role": "user", "content": question})
+        return messages
 
     def _extract_references(self, text: str) -> List[str]:
         """Extract reference IDs from text."""
-        pattern = r'\[([\d\.]+)\]'
-        return re.findall(pattern, text)
+        return _REF_RE.findall(text)
+
+    def _scan_references(self, tail: str, content: str, references: set) -> str:
+        """Add reference IDs found in a streamed delta; returns the unfinished tail to prepend to the next one."""
+        pending = tail + content
+        last_end = 0
+        for match in _REF_RE.finditer(pending):
+            references.add(match.group(1))
+            last_end = match.end()
+        open_at = pending.rfind('[', last_end)
+        return pending[open_at:open_at + REF_TAIL_MAX] if open_at != -1 else ""
 
-    async def process_message_stream(self, message: str, context: Optional[List[Dict[str, Any]]] = None, websocket=None):
-        """Process a message with streaming response."""
+    async def process_message_stream(self, message: str, context: Optional[List[Dict[str, Any]]] = None, websocket=None) -> Dict[str, Any]:
+        """Process a message with streaming response and return the full response."""
         try:
-            logger.debug(f"Processing message stream: {message[:100]}...")
-            prompt = self._create_qa_prompt(message, context)
-            full_response = ""
+            logger.debug("Processing message stream: %.100s...", message)
+            parts = []
             references = set()
 
-            stream = self.client.chat.completions.create(
-                model=self.model,
-                messages=[
-                    {"role": "system", "content": "You are a helpful AI assistant. Provide clear, concise, and accurate responses. Maintain a natural conversation flow and cite sources when using document context."},
-                    {"role": "user", "content": prompt}
-                ],
-                temperature=self.temperature,
-                max_tokens=self.max_tokens,
-                stream=True
-            )
+            messages = self._build_messages(message, context)
+            # The concurrency slot is held until the stream is fully consumed
+            async with rate_limiter.limit(estimate_tokens(messages, self.max_tokens)):
+                stream = await self.client.chat.completions.create(
+                    model=self.model,
+                    messages=messages,
+                    temperature=self.temperature,
+                    max_tokens=self.max_tokens,
+                    stream=True
+                )
 
-            for chunk in stream:
-                if chunk.choices[0].delta.content:
-                    content = chunk.choices[0].delta.content
-                    full_response += content
-                    if websocket:
-                        await websocket.send_json({
+                batch = []
+                batch_chars = 0
+                ref_tail = ""
+                batch_size = STREAM_MIN_BATCH_SIZE
+                flush_interval = STREAM_FLUSH_MS / 1000
+                last_flush = time.monotonic()
+                async for chunk in stream:
+                    # Role-only, finish and usage chunks carry no text
+                    if not chunk.choices or not (content := chunk.choices[0].delta.content):
+                        continue
+                    parts.append(content)
+                    batch.append(content)
+                    batch_chars += len(content)
+                    if context:
+                        ref_tail = self._scan_references(ref_tail, content, references)
+                    if not websocket:
+                        continue
+                    now = time.monotonic()
+                    if len(batch) >= batch_size or batch_chars >= STREAM_FLUSH_CHARS or now - last_flush >= flush_interval:
+                        await send_json(websocket, {
                             "type": "stream",
-                            "content": content
+                            "content": "".join(batch)
                         })
+                        batch = []
+                        batch_chars = 0
+                        batch_size = min(STREAM_BATCH_SIZE, math.ceil(batch_size * STREAM_BATCH_GROWTH_FACTOR))
+                        last_flush = now
 
-            # Extract references from the full response
+                if websocket and batch:
+                    await send_json(websocket, {
+                        "type": "stream",
+                        "content": "".join(batch)
+                    })
+            full_response = "".join(parts)
+
+            # References were collected while streaming
             if context:
-                refs = self._extract_references(full_response)
-                references.update(refs)
                 if websocket and references:
-                    await websocket.send_json({
+                    await send_json(websocket, {
                         "type": "references",
                         "references": list(references)
                     })
 
             logger.info("Message stream processed successfully")
+            return {
+                "response": full_response,
+                "references": list(references)
+            }
 
         except Exception as e:
             error_msg = f"Error processing message: {str(e)}"
             logger.error(error_msg)
             if websocket:
-                await websocket.send_json({
+                await send_json(websocket, {
                     "type": "error",
                     "content": error_msg
                 })
             raise
 
+    async def process_command_stream(self, command: str, message: str, websocket) -> Dict[str, Any]:
+        """Run a tool command for a WebSocket client, sending streamable tools item by item."""
+        try:
+            logger.debug("Processing tool command stream: %s", command)
+            stream = self.tools.streams.get(command)
+            if stream is None:
+                result = await self.tools.execute_command(command, message)
+                response = self.format_response(command, result)
+                await send_json(websocket, {"type": "stream", "content": response})
+                return {"response": response}
+
+            header, template, separator = STREAM_FORMATS[command]
+            parts = [header]
+            await send_json(websocket, {"type": "stream", "content": header})
+            async for item in stream(message):
+                part = (separator if len(parts) > 1 else "") + template.format(item)
+                parts.append(part)
+                await send_json(websocket, {"type": "stream", "content": part})
+            return {"response": "".join(parts)}
+
+        except Exception as e:
+            error_msg = f"Error processing command: {str(e)}"
+            logger.error(error_msg)
+            await send_json(websocket, {
+                "type": "error",
+                "content": error_msg
+            })
+            raise
+
+    async def prepare_prompt(self, message: str) -> Dict[str, Any]:
+        """Resolve tool routing for a message; needs no context, so it can run alongside retrieval."""
+        return {"message": message, "command": self.tools.extract_command(message)}
+
     async def process_message(self, message: str, context: Optional[List[Dict[str, Any]]] = None) -> Dict[str, Any]:
         """Process a message and return the response."""
+        return await self.process_prepared(await self.prepare_prompt(message), context)
+
+    async def process_prepared(self, prepared: Dict[str, Any], context: Optional[List[Dict[str, Any]]] = None) -> Dict[str, Any]:
+        """Process a message returned by prepare_prompt once its context is known."""
+        message, command = prepared["message"], prepared["command"]
         try:
-            logger.debug(f"Processing message: {message[:100]}...")
+            logger.debug("Processing message: %.100s...", message)
 
             # Check if it's a tool command
-            command = self.tools.extract_command(message)
             if command:
-                logger.debug(f"Processing tool command: {command}")
+                logger.debug("Processing tool command: %s", command)
                 result = await self.tools.execute_command(command, message)
                 return {"response": self.format_response(command, result)}
 
-            prompt = self._create_qa_prompt(message, context)
             references = set()
 
-            response = self.client.chat.completions.create(
-                model=self.model,
-                messages=[
-                    {"role": "system", "content": "You are a helpful AI assistant. Provide clear, concise, and accurate responses."},
-                    {"role": "user", "content": prompt}
-                ],
-                temperature=self.temperature,
-                max_tokens=self.max_tokens
-            )
+            messages = self._build_messages(message, context)
+            async with rate_limiter.limit(estimate_tokens(messages, self.max_tokens)):
+                response = await self.client.chat.completions.create(
+                    model=self.model,
+                    messages=messages,
+                    temperature=self.temperature,
+                    max_tokens=self.max_tokens
+                )
 
             result = {
                 "response": response.choices[0].message.content
@@ -180,7 +384,7 @@ Question: {question}"""
                 response = self.format_response(command, result)
 
                 if websocket:
-                    await websocket.send_json({
+                    await send_json(websocket, {
                         "type": "tool_response",
                         "content": response
                     })
@@ -191,13 +395,13 @@ Question: {question}"""
                 await self.process_message_stream(message, context, websocket)
                 return ""
             else:
-                result = self.process_message(message, context)
+                result = await self.process_message(message, context)
                 return result["response"]
 
         except Exception as e:
             error_msg = f"Error processing message with tools: {str(e)}"
             if websocket:
-                await websocket.send_json({
+                await send_json(websocket, {
                     "type": "error",
                     "content": error_msg
                 })
@@ -208,21 +412,5 @@ Question: {question}"""
         if "error" in result:
             return f"❌ **Error:** {result['error']}"
 
-        if command == "analyze":
-            return f"🔍 **Analysis:**\n{result['analysis']}"
-        elif command == "translate":
-            return f"🌐 **Translation:**\n{result['translation']}"
-        elif command == "summarize":
-            return f"📝 **Summary:**\n{result['summary']}"
-        elif command == "classify":
-            return f"🏷️ **Classification:**\n{result['classification']}"
-        elif command == "questions":
-            return "❓ **Questions:**\n" + "\n".join(f"• {q}" for q in result['questions'])
-        elif command == "keywords":
-            return "🔑 **Keywords:**\n" + ", ".join(result['keywords'])
-        elif command == "code":
-            return result['code']
-        elif command == "entities":
-            return "👥 **Entities:**\n" + "\n".join(f"• {e}" for e in result['entities'])
-        else:
-            return str(result)
+        formatter = RESPONSE_FORMATTERS.get(command)
+        return formatter(result) if formatter else str(result)
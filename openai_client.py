@@ -0,0 +1,134 @@
+import os
+import time
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from functools import lru_cache
+from typing import Any, Dict, List, Optional
+import httpx
+from dotenv import load_dotenv
+from openai import AsyncOpenAI
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+# One pooled client per worker process keeps TLS sessions alive across requests
+OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", "200"))
+OPENAI_MAX_KEEPALIVE = int(os.getenv("OPENAI_MAX_KEEPALIVE", "200"))
+OPENAI_KEEPALIVE_EXPIRY = float(os.getenv("OPENAI_KEEPALIVE_EXPIRY", "60"))
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "30"))
+OPENAI_CONNECT_TIMEOUT = float(os.getenv("OPENAI_CONNECT_TIMEOUT", "5"))
+# The SDK retries 429s, 5xx, timeouts and connection errors with jittered exponential backoff
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "5"))
+OPENAI_HTTP2 = os.getenv("OPENAI_HTTP2", "true").lower() == "true"
+# "aiohttp" has lower per-request overhead with hundreds of requests in flight; needs openai[aiohttp]
+OPENAI_HTTP_BACKEND = os.getenv("OPENAI_HTTP_BACKEND", "httpx").lower()
+OPENAI_DNS_CACHE_TTL = int(os.getenv("OPENAI_DNS_CACHE_TTL", "300"))
+
+# Client-side throttling keeps large batches under the account's rate limits instead of retrying 429s
+OPENAI_MAX_RPM = int(os.getenv("OPENAI_MAX_RPM", "3500"))
+OPENAI_MAX_TPM = int(os.getenv("OPENAI_MAX_TPM", "1000000"))
+OPENAI_MAX_CONCURRENT = int(os.getenv("OPENAI_MAX_CONCURRENT", "64"))
+
+def _limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=OPENAI_MAX_CONNECTIONS,
+        max_keepalive_connections=OPENAI_MAX_KEEPALIVE,
+        keepalive_expiry=OPENAI_KEEPALIVE_EXPIRY,
+    )
+
+def _timeout() -> httpx.Timeout:
+    return httpx.Timeout(OPENAI_TIMEOUT, connect=OPENAI_CONNECT_TIMEOUT)
+
+_open_clients: List[AsyncOpenAI] = []
+
+def _http_client() -> httpx.AsyncClient:
+    if OPENAI_HTTP_BACKEND == "aiohttp":
+        # Imported lazily so the aiohttp extra is only required when selected
+        import aiohttp
+        from httpx_aiohttp import AiohttpTransport
+        from openai import DefaultAioHttpClient
+
+        # httpx Limits only map to the connector's total limit, so the connector is built here.
+        # The transport creates the session on first request, inside the running event loop.
+        def session() -> aiohttp.ClientSession:
+            return aiohttp.ClientSession(connector=aiohttp.TCPConnector(
+                limit=OPENAI_MAX_CONNECTIONS,
+                limit_per_host=OPENAI_MAX_CONNECTIONS,
+                keepalive_timeout=OPENAI_KEEPALIVE_EXPIRY,
+                ttl_dns_cache=OPENAI_DNS_CACHE_TTL,
+            ))
+
+        return DefaultAioHttpClient(transport=AiohttpTransport(client=session), timeout=_timeout())
+    return httpx.AsyncClient(limits=_limits(), timeout=_timeout(), http2=OPENAI_HTTP2)
+
+@lru_cache(maxsize=1)
+def _async_client(api_key: Optional[str]) -> AsyncOpenAI:
+    logger.debug("Creating shared async OpenAI client with %s backend", OPENAI_HTTP_BACKEND)
+    client = AsyncOpenAI(api_key=api_key, http_client=_http_client(), max_retries=OPENAI_MAX_RETRIES)
+    _open_clients.append(client)
+    return client
+
+def get_async_client(api_key: Optional[str] = None) -> AsyncOpenAI:
+    """Return the shared async OpenAI client for an API key, creating it on first use."""
+    return _async_client(api_key or os.getenv("OPENAI_API_KEY"))
+
+async def close_clients():
+    """Close every client created by the factory and their connection pools."""
+    _async_client.cache_clear()
+    while _open_clients:
+        await _open_clients.pop().close()
+
+class RateLimiter:
+    """Token buckets for requests and tokens per minute, plus a cap on requests in flight."""
+
+    def __init__(self, max_requests_per_minute: int, max_tokens_per_minute: int, max_concurrent: int):
+        self.max_requests_per_minute = max_requests_per_minute
+        self.max_tokens_per_minute = max_tokens_per_minute
+        self.available_requests = float(max_requests_per_minute)
+        self.available_tokens = float(max_tokens_per_minute)
+        self.last_refill = time.monotonic()
+        self.semaphore = asyncio.Semaphore(max_concurrent)
+        self.lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self.last_refill
+        self.last_refill = now
+        self.available_requests = min(
+            self.max_requests_per_minute,
+            self.available_requests + elapsed * self.max_requests_per_minute / 60
+        )
+        self.available_tokens = min(
+            self.max_tokens_per_minute,
+            self.available_tokens + elapsed * self.max_tokens_per_minute / 60
+        )
+
+    async def acquire(self, tokens: int):
+        """Wait until both buckets can pay for one request of the given token estimate."""
+        tokens = min(tokens, self.max_tokens_per_minute)
+        async with self.lock:
+            while True:
+                self._refill()
+                if self.available_requests >= 1 and self.available_tokens >= tokens:
+                    self.available_requests -= 1
+                    self.available_tokens -= tokens
+                    return
+                await asyncio.sleep(max(
+                    (1 - self.available_requests) * 60 / self.max_requests_per_minute,
+                    (tokens - self.available_tokens) * 60 / self.max_tokens_per_minute
+                ))
+
+    @asynccontextmanager
+    async def limit(self, tokens: int):
+        """Hold a concurrency slot while one rate-limited request is issued."""
+        async with self.semaphore:
+            await self.acquire(tokens)
+            yield
+
+def estimate_tokens(messages: List[Dict[str, Any]], max_tokens: int) -> int:
+    """Rough token cost of a request: about four characters per prompt token, plus the completion budget."""
+    return sum(len(message["content"]) for message in messages) // 4 + max_tokens
+
+rate_limiter = RateLimiter(OPENAI_MAX_RPM, OPENAI_MAX_TPM, OPENAI_MAX_CONCURRENT)
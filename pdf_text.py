@@ -0,0 +1,33 @@
+import io
+import logging
+from typing import BinaryIO, Iterator, List
+from pypdf import PdfReader
+
+# Kept free of heavy imports: PDF worker processes import only this module
+logger = logging.getLogger(__name__)
+
+def iter_pdf_pages(pdf: bytes | BinaryIO) -> Iterator[str]:
+    """Yield the text of each PDF page in order"""
+    try:
+        pdf_file = io.BytesIO(pdf) if isinstance(pdf, bytes) else pdf
+        reader = PdfReader(pdf_file)
+        logger.debug("Extracting text from PDF with %d pages", len(reader.pages))
+        for i, page in enumerate(reader.pages):
+            page_text = page.extract_text() or ""
+            logger.debug("Extracted %d characters from page %d", len(page_text), i + 1)
+            yield page_text
+    except Exception as e:
+        logger.error("PDF extraction error: %s", e)
+        raise ValueError(f"Failed to extract text from PDF: {str(e)}")
+
+def extract_text_from_pdf(pdf: bytes | BinaryIO) -> str:
+    """Extract text from PDF bytes or a binary file"""
+    return "\n".join(iter_pdf_pages(pdf)).strip()
+
+def extract_page_range(pdf_bytes: bytes, start: int, stop: int) -> List[str]:
+    """Extract the text of pages [start, stop); runs in a worker process"""
+    reader = PdfReader(io.BytesIO(pdf_bytes))
+    return [reader.pages[i].extract_text() or "" for i in range(start, stop)]
+
+def count_pdf_pages(pdf_bytes: bytes) -> int:
+    return len(PdfReader(io.BytesIO(pdf_bytes)).pages)
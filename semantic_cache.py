@@ -0,0 +1,170 @@
+import orjson
+import time
+import hashlib
+import sqlite3
+import threading
+import logging
+from collections import OrderedDict
+from typing import Dict, Any, List, Optional, Tuple
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+class SemanticCache:
+    """Cache of query results looked up by embedding similarity, persisted in SQLite.
+
+    Embeddings are expected to be L2-normalized, so similarity is a plain dot product.
+    Methods do blocking disk I/O and are safe to call from worker threads.
+    """
+
+    def __init__(self, path: str, threshold: float = 0.9, ttl: int = 3600, max_entries: int = 1000):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS cache (
+                key TEXT PRIMARY KEY,
+                namespace TEXT NOT NULL,
+                embedding BLOB NOT NULL,
+                response TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                last_used REAL NOT NULL
+            )"""
+        )
+        self.conn.commit()
+
+    def _key(self, namespace: str, query: str) -> str:
+        return hashlib.sha256(f"{namespace}\0{query}".encode("utf-8")).hexdigest()
+
+    def lookup(self, namespace: str, embedding: List[float]) -> Optional[Any]:
+        """Return the cached response whose query embedding is most similar, if above threshold."""
+        with self.lock:
+            now = time.time()
+            self.conn.execute("DELETE FROM cache WHERE created_at < ?", (now - self.ttl,))
+            # Commit at once so a miss never holds the write lock while the caller does slow work
+            self.conn.commit()
+            rows = self.conn.execute(
+                "SELECT key, embedding, response FROM cache WHERE namespace = ?", (namespace,)
+            ).fetchall()
+            if not rows:
+                self.misses += 1
+                return None
+
+            query = np.asarray(embedding, dtype=np.float32)
+            matrix = np.frombuffer(b"".join(row[1] for row in rows), dtype=np.float32).reshape(len(rows), -1)
+            scores = matrix @ query
+            best = int(np.argmax(scores))
+            if scores[best] < self.threshold:
+                self.misses += 1
+                return None
+
+            self.conn.execute("UPDATE cache SET last_used = ? WHERE key = ?", (now, rows[best][0]))
+            self.conn.commit()
+            self.hits += 1
+            logger.debug("Semantic cache hit with similarity %.3f", scores[best])
+            return orjson.loads(rows[best][2])
+
+    def insert(self, namespace: str, query: str, embedding: List[float], response: Any):
+        """Store a response, evicting the least recently used entries beyond max_entries."""
+        with self.lock:
+            now = time.time()
+            self.conn.execute(
+                "INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    self._key(namespace, query),
+                    namespace,
+                    np.asarray(embedding, dtype=np.float32).tobytes(),
+                    orjson.dumps(response).decode(),
+                    now,
+                    now,
+                ),
+            )
+            self.conn.execute(
+                "DELETE FROM cache WHERE key NOT IN (SELECT key FROM cache ORDER BY last_used DESC LIMIT ?)",
+                (self.max_entries,),
+            )
+            self.conn.commit()
+
+    def clear(self, namespace: Optional[str] = None):
+        """Drop cached responses, optionally only those of one namespace."""
+        with self.lock:
+            if namespace is None:
+                self.conn.execute("DELETE FROM cache")
+            else:
+                self.conn.execute("DELETE FROM cache WHERE namespace = ?", (namespace,))
+            self.conn.commit()
+
+    def stats(self) -> Dict[str, Any]:
+        """Return hit/miss counters and the number of stored entries."""
+        with self.lock:
+            entries = self.conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": entries
+        }
+
+    def close(self):
+        """Close the underlying database connection."""
+        with self.lock:
+            self.conn.close()
+
+
+class ExactCache:
+    """In-memory LRU of responses keyed by normalized query text, checked before any embedding."""
+
+    def __init__(self, max_entries: int = 4096, ttl: int = 3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.entries: "OrderedDict[Tuple[str, str], Tuple[float, Any]]" = OrderedDict()
+
+    @staticmethod
+    def normalize(query: str) -> str:
+        return query.strip().lower()
+
+    def get(self, namespace: str, query: str) -> Optional[Any]:
+        """Return the response cached for exactly this query, if still fresh."""
+        key = (namespace, self.normalize(query))
+        entry = self.entries.get(key)
+        if entry is None or time.time() - entry[0] > self.ttl:
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, namespace: str, query: str, response: Any):
+        """Store a response, evicting the least recently used entries beyond max_entries."""
+        key = (namespace, self.normalize(query))
+        self.entries[key] = (time.time(), response)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def clear(self, namespace: Optional[str] = None):
+        """Drop cached responses, optionally only those of one namespace."""
+        if namespace is None:
+            self.entries.clear()
+        else:
+            for key in [key for key in self.entries if key[0] == namespace]:
+                del self.entries[key]
+
+    def stats(self) -> Dict[str, Any]:
+        """Return hit/miss counters and the number of stored entries."""
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": len(self.entries)
+        }
@@ -0,0 +1,45 @@
+import logging
+from functools import lru_cache
+from typing import List, Protocol, Sequence
+
+logger = logging.getLogger(__name__)
+
+class Encoding(Protocol):
+    def encode(self, text: str) -> Sequence: ...
+    def decode(self, tokens: Sequence) -> str: ...
+
+class CharEncoding:
+    """Four-character chunks standing in for tokens when no tiktoken encoding can be loaded.
+
+    Matches the chars/4 estimate used for rate limiting, so lengths are approximate but
+    slicing and decoding still round-trip the text.
+    """
+
+    def encode(self, text: str) -> List[str]:
+        return [text[i:i + 4] for i in range(0, len(text), 4)]
+
+    def decode(self, tokens: Sequence[str]) -> str:
+        return "".join(tokens)
+
+@lru_cache(maxsize=8)
+def get_encoding(name: str = "cl100k_base") -> Encoding:
+    """Load a tiktoken encoding on first use; tiktoken downloads it, which can fail offline."""
+    try:
+        import tiktoken
+        return tiktoken.get_encoding(name)
+    except Exception as e:
+        logger.warning("Could not load tiktoken encoding %s, estimating tokens as four characters: %s", name, e)
+        return CharEncoding()
+
+@lru_cache(maxsize=8)
+def encoding_for_model(model: str) -> Encoding:
+    """The model's tiktoken encoding, cl100k_base for unknown models, or the character estimate."""
+    try:
+        import tiktoken
+        name = tiktoken.encoding_name_for_model(model)
+    except KeyError:
+        name = "cl100k_base"
+    except Exception as e:
+        logger.warning("Could not resolve tiktoken encoding for %s: %s", model, e)
+        return CharEncoding()
+    return get_encoding(name)
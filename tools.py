@@ -1,9 +1,36 @@
-from typing import Dict, Any, List, Callable, Optional
+from typing import Dict, Any, List, Callable, Optional, Tuple, AsyncIterator
+import asyncio
+import hashlib
+import json
+from contextvars import ContextVar
 import openai
-from openai import OpenAI
-from functools import wraps
+import orjson
+from openai import AsyncOpenAI
 import os
+import logging
 from dotenv import load_dotenv
+from openai_client import get_async_client, rate_limiter, estimate_tokens
+from semantic_cache import SemanticCache, ExactCache
+from tokenizer import encoding_for_model as encoding_for
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4")
+# Short, low-reasoning tools run on a smaller model; the rest use the configured model
+OPENAI_UTILITY_MODEL = os.getenv("OPENAI_UTILITY_MODEL", "gpt-4o-mini")
+# Structured outputs (json_schema) need a gpt-4o-family model
+OPENAI_ANALYSIS_MODEL = os.getenv("OPENAI_ANALYSIS_MODEL", "gpt-4o")
+MODEL_TIERS = {
+    "analyze": OPENAI_ANALYSIS_MODEL,
+    "bundle": OPENAI_ANALYSIS_MODEL,
+    "classify": OPENAI_UTILITY_MODEL,
+    "keywords": OPENAI_UTILITY_MODEL,
+    "questions": OPENAI_UTILITY_MODEL,
+    "translate": OPENAI_UTILITY_MODEL,
+    "entities": OPENAI_UTILITY_MODEL,
+}
 
 class ToolRegistry:
     def __init__(self):
@@ -14,17 +41,231 @@ class ToolRegistry:
         def decorator(func: Callable):
             self.tools[name] = func
             self.descriptions[name] = description
-            @wraps(func)
-            def wrapper(*args, **kwargs):
-                return func(*args, **kwargs)
-            return wrapper
+            return func
         return decorator
 
+# Offline batches trade latency (up to 24h) for half-price tokens and a separate rate-limit pool
+BATCH_API_WINDOW_MS = int(os.getenv("BATCH_API_WINDOW_MS", "500"))
+BATCH_API_POLL_SECONDS = float(os.getenv("BATCH_API_POLL_SECONDS", "5"))
+BATCH_API_MAX_POLL_SECONDS = float(os.getenv("BATCH_API_MAX_POLL_SECONDS", "300"))
+
+# Repeated tool calls on the same text are answered from memory instead of another completion
+PROMPT_CACHE_SIZE = int(os.getenv("PROMPT_CACHE_SIZE", "4096"))
+PROMPT_CACHE_TTL = int(os.getenv("PROMPT_CACHE_TTL", "3600"))
+# Near-duplicate lookup costs one embedding call per miss, so it is opt-in
+PROMPT_SEMANTIC_CACHE = os.getenv("PROMPT_SEMANTIC_CACHE", "false").lower() == "true"
+PROMPT_SEMANTIC_THRESHOLD = float(os.getenv("PROMPT_SEMANTIC_THRESHOLD", "0.95"))
+PROMPT_EMBEDDING_MODEL = os.getenv("PROMPT_EMBEDDING_MODEL", "text-embedding-3-small")
+
+def prompt_key(*parts: Any) -> str:
+    """Stable short digest of the parts that determine a completion."""
+    return hashlib.blake2b(json.dumps(parts, sort_keys=True).encode("utf-8"), digest_size=16).hexdigest()
+
+# System prompts never contain request data, so OpenAI's prompt cache can reuse the prefix
+SYSTEM_PROMPTS = {
+    "analyze": "Analyze the text in the user message for sentiment, tone, and key points. Format your response with clear sections.",
+    "translate": (
+        "Translate the text in the user message to the language given on its \"Target language:\" line. "
+        "Maintain the original formatting and style. Respond with only the translation."
+    ),
+    "summarize": "Provide a concise summary of the text in the user message. Focus on key points and main ideas.",
+    "classify": (
+        "Classify the text in the user message into one of the categories listed on its \"Categories:\" line. "
+        "Explain your reasoning."
+    ),
+    "questions": "Generate 3-5 relevant questions about the text in the user message. Make them thought-provoking and specific.",
+    "questions_lines": "Generate 3-5 relevant questions about the text in the user message. Make them thought-provoking and specific. Put each question on its own line.",
+    "keywords": "Extract key terms and phrases from the text in the user message. Focus on important concepts and technical terms.",
+    "keywords_list": (
+        "Extract key terms and phrases from the text in the user message. Focus on important concepts and technical terms. "
+        "Respond with a comma-separated list."
+    ),
+    "code": """Generate code in the language given on the "Language:" line, based on the description in the user message.
+Include:
+1. Proper code formatting with markdown
+2. Comments explaining the code
+3. Error handling where appropriate
+4. Example usage if relevant""",
+    "entities": "Extract named entities (people, places, organizations) from the text in the user message, each with its type (e.g., Person, Place, Organization).",
+    "bundle": (
+        "Analyze the text in the user message in one pass. Give an analysis of its sentiment, tone, and key points; "
+        "a concise summary of at most 150 words; up to 5 key terms; and 3 thought-provoking, specific questions about it."
+    ),
+    "entities_lines": """Extract named entities (people, places, organizations) from the text in the user message.
+Put each entity on its own line with its type (e.g., "Person: John Smith", "Organization: Acme Corp").""",
+}
+
+# Model families that accept response_format json_schema; others fall back to json_object
+STRUCTURED_OUTPUT_MODELS = tuple(
+    os.getenv("STRUCTURED_OUTPUT_MODELS", "gpt-4o,gpt-4.1,gpt-5,o1,o3,o4").split(",")
+)
+
+def supports_json_schema(model: str) -> bool:
+    return model.startswith(STRUCTURED_OUTPUT_MODELS)
+
+def _strings(value: Any) -> List[str]:
+    """Stripped, non-empty strings from a parsed JSON array; JSON mode does not enforce item types."""
+    if not isinstance(value, list):
+        return []
+    return [item.strip() for item in value if isinstance(item, str) and item.strip()]
+
+def _string_list(key: str) -> Dict[str, Any]:
+    return {
+        "type": "object",
+        "properties": {key: {"type": "array", "items": {"type": "string"}}},
+        "required": [key],
+        "additionalProperties": False
+    }
+
+# Structured output schemas; strict mode requires every property to be listed as required
+JSON_SCHEMAS = {
+    "classify": {
+        "type": "object",
+        "properties": {"category": {"type": "string"}, "reasoning": {"type": "string"}},
+        "required": ["category", "reasoning"],
+        "additionalProperties": False
+    },
+    "questions": _string_list("questions"),
+    "keywords": _string_list("keywords"),
+    "bundle": {
+        "type": "object",
+        "properties": {
+            "analysis": {"type": "string"},
+            "summary": {"type": "string"},
+            "keywords": {"type": "array", "items": {"type": "string"}},
+            "questions": {"type": "array", "items": {"type": "string"}}
+        },
+        "required": ["analysis", "summary", "keywords", "questions"],
+        "additionalProperties": False
+    },
+    "entities": {
+        "type": "object",
+        "properties": {"entities": {"type": "array", "items": {
+            "type": "object",
+            "properties": {"type": {"type": "string"}, "value": {"type": "string"}},
+            "required": ["type", "value"],
+            "additionalProperties": False
+        }}},
+        "required": ["entities"],
+        "additionalProperties": False
+    },
+}
+
+# Tool input is truncated so the prompt plus completion budget always fits the model window.
+# (context window, max completion tokens) by model prefix; more specific prefixes come first.
+MODEL_LIMITS: Dict[str, Tuple[int, int]] = {
+    "gpt-4o": (128000, 16384),
+    "gpt-4.1": (1047576, 32768),
+    "gpt-4-turbo": (128000, 4096),
+    "gpt-4-32k": (32768, 8192),
+    "gpt-4": (8192, 8192),
+    "gpt-3.5-turbo": (16385, 4096),
+    "gpt-5": (400000, 128000),
+    "o1": (200000, 100000),
+    "o3": (200000, 100000),
+    "o4": (200000, 100000),
+}
+# Limits assumed for models missing from MODEL_LIMITS
+TOOL_CONTEXT_TOKENS = int(os.getenv("TOOL_CONTEXT_TOKENS", "8192"))
+TOOL_OUTPUT_TOKENS = int(os.getenv("TOOL_OUTPUT_TOKENS", "4096"))
+# Input limit of the prompt cache's embedding model
+EMBEDDING_INPUT_TOKENS = 8191
+# Per-message framing tokens added by the chat format
+PROMPT_OVERHEAD_TOKENS = 16
+# Numbering and separator tokens around each text in a bulk prompt
+BULK_ITEM_OVERHEAD_TOKENS = 8
+
+def model_limits(model: str) -> Tuple[int, int]:
+    """Context window and completion limit for a model, by longest known prefix."""
+    for prefix, limits in MODEL_LIMITS.items():
+        if model.startswith(prefix):
+            return limits
+    return TOOL_CONTEXT_TOKENS, TOOL_OUTPUT_TOKENS
+
+# Set while running an offline batch so completions are routed to the Batch API
+_async_batch: ContextVar[bool] = ContextVar("async_batch", default=False)
+
+class BatchRequestError(openai.OpenAIError):
+    """A Batch API job, or one request within it, did not complete successfully."""
+
+class BatchDispatcher:
+    """Collects chat completion requests for a short window and runs them as one OpenAI Batch API job."""
+
+    def __init__(self, client: AsyncOpenAI, window_ms: int = BATCH_API_WINDOW_MS):
+        self.client = client
+        self.window = window_ms / 1000
+        self.pending: List[Tuple[Dict[str, Any], asyncio.Future]] = []
+        self._flush_task: Optional[asyncio.Task] = None
+
+    async def complete(self, body: Dict[str, Any]) -> str:
+        """Queue one chat completion request body and wait for its batch to finish."""
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((body, future))
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_later())
+        return await future
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.window)
+        pending, self.pending, self._flush_task = self.pending, [], None
+        try:
+            results = await self.run([body for body, _ in pending])
+        except Exception as e:
+            for _, future in pending:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), result in zip(pending, results):
+            if future.done():
+                continue
+            if result is None:
+                future.set_exception(BatchRequestError("Batch request failed"))
+            else:
+                future.set_result(result)
+
+    async def run(self, bodies: List[Dict[str, Any]]) -> List[Optional[str]]:
+        """Submit request bodies as one batch, poll until it ends, and return contents in order."""
+        lines = [
+            json.dumps({"custom_id": str(i), "method": "POST", "url": "/v1/chat/completions", "body": body})
+            for i, body in enumerate(bodies)
+        ]
+        batch_file = await self.client.files.create(file=("batch.jsonl", "\n".join(lines).encode("utf-8")), purpose="batch")
+        batch = await self.client.batches.create(
+            input_file_id=batch_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h"
+        )
+        delay = BATCH_API_POLL_SECONDS
+        while batch.status not in ("completed", "failed", "expired", "cancelled"):
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, BATCH_API_MAX_POLL_SECONDS)
+            batch = await self.client.batches.retrieve(batch.id)
+        if batch.status != "completed" or not batch.output_file_id:
+            raise BatchRequestError(f"Batch {batch.id} ended with status {batch.status}")
+
+        output = await self.client.files.content(batch.output_file_id)
+        results: Dict[str, Optional[str]] = {}
+        for line in output.text.splitlines():
+            if line.strip():
+                item = json.loads(line)
+                response = item.get("response") or {}
+                results[item["custom_id"]] = (
+                    response["body"]["choices"][0]["message"]["content"]
+                    if response.get("status_code") == 200 else None
+                )
+        return [results.get(str(i)) for i in range(len(bodies))]
+
 class OpenAITools:
-    def __init__(self, api_key: str):
-        load_dotenv()
-        self.client = OpenAI(api_key=api_key)
-        self.model = os.getenv("OPENAI_MODEL", "gpt-4")
+    def __init__(self, api_key: str, client: Optional[AsyncOpenAI] = None):
+        self.client = client or get_async_client(api_key)
+        self.batch_dispatcher = BatchDispatcher(self.client)
+        self.prompt_cache = ExactCache(max_entries=PROMPT_CACHE_SIZE, ttl=PROMPT_CACHE_TTL)
+        self.semantic_prompt_cache = (
+            SemanticCache(":memory:", threshold=PROMPT_SEMANTIC_THRESHOLD, ttl=PROMPT_CACHE_TTL, max_entries=PROMPT_CACHE_SIZE)
+            if PROMPT_SEMANTIC_CACHE else None
+        )
+        self.model = OPENAI_MODEL
+        self.model_tiers = dict(MODEL_TIERS)
         self.registry = ToolRegistry()
         self.settings = {
             "maxTokens": 2000,
@@ -32,93 +273,374 @@ class OpenAITools:
             "model": self.model
         }
         self._register_tools()
+        # Tools whose items can be sent to the client while the completion is still generating
+        self.streams: Dict[str, Callable[[str], AsyncIterator[str]]] = {
+            "entities": self.stream_entities,
+            "questions": self.stream_questions,
+            "keywords": self.stream_keywords,
+        }
 
     def update_settings(self, settings: Dict[str, Any]):
-        """Update the settings for the OpenAI client."""
+        """Update the settings for the OpenAI client.
+
+        A "modelTiers" mapping of tool name to model overrides the per-tool model choice.
+        """
+        settings = dict(settings)
+        self.model_tiers.update(settings.pop("modelTiers", None) or {})
         self.settings.update(settings)
         self.model = settings.get("model", self.model)
 
-    def _create_completion(self, system_prompt: str, user_prompt: str) -> str:
-        """Create a completion with the given prompts."""
-        response = self.client.chat.completions.create(
-            model=self.settings["model"],
-            messages=[
+    def _model_for(self, tool: Optional[str]) -> str:
+        return self.model_tiers.get(tool) or self.settings["model"]
+
+    async def _embed(self, text: str) -> List[float]:
+        enc = encoding_for(PROMPT_EMBEDDING_MODEL)
+        ids = enc.encode(text)
+        if len(ids) > EMBEDDING_INPUT_TOKENS:
+            # Tool windows are far larger than the embedder's; the head of the text is enough to match on
+            text = enc.decode(ids[:EMBEDDING_INPUT_TOKENS])
+        response = await self.client.embeddings.create(model=PROMPT_EMBEDDING_MODEL, input=text)
+        return response.data[0].embedding
+
+    def _fit(self, system_prompt: str, user_prompt: str, model: str, max_tokens: int) -> str:
+        """Truncate the user prompt to what fits beside the system prompt and completion budget."""
+        enc = encoding_for(model)
+        context_tokens, _ = model_limits(model)
+        budget = context_tokens - max_tokens - 2 * PROMPT_OVERHEAD_TOKENS
+        budget -= len(enc.encode(system_prompt))
+        if budget <= 0:
+            raise ValueError(f"Completion budget of {max_tokens} tokens leaves no room for input")
+        ids = enc.encode(user_prompt)
+        if len(ids) <= budget:
+            return user_prompt
+        logger.debug("Truncating tool input from %d to %d tokens", len(ids), budget)
+        return enc.decode(ids[:budget])
+
+    def _request_body(self, system_prompt: str, user_prompt: str, model: str, max_tokens: int, **options: Any) -> Dict[str, Any]:
+        """Build the chat completion request shared by every call path."""
+        return {
+            "model": model,
+            "messages": [
                 {"role": "system", "content": system_prompt},
                 {"role": "user", "content": user_prompt}
             ],
-            temperature=self.settings["temperature"],
-            max_tokens=self.settings["maxTokens"]
-        )
+            "temperature": self.settings["temperature"],
+            "max_tokens": max_tokens,
+            **options
+        }
+
+    async def _create_completion(
+        self,
+        system_prompt: str,
+        user_prompt: str,
+        response_format: Optional[Dict[str, Any]] = None,
+        max_tokens: Optional[int] = None,
+        tool: Optional[str] = None,
+        args: Optional[Dict[str, str]] = None
+    ) -> str:
+        """Create a completion with the given prompts, answering repeats from the prompt caches.
+
+        Every non-streaming call goes through here, so truncation, caching, rate limiting
+        and Batch API routing apply to all tools alike. ``user_prompt`` is the free text;
+        ``args`` are sent as "Name: value" lines ahead of it and must match exactly for a
+        semantic cache hit.
+        """
+        model = self._model_for(tool)
+        max_tokens = max_tokens or self.settings["maxTokens"]
+        header = "\n".join(f"{name}: {value}" for name, value in (args or {}).items())
+        text = self._fit(system_prompt + header, user_prompt, model, max_tokens)
+        user_prompt = f"{header}\n\nText:\n{text}" if header else text
+        settings = (model, self.settings["temperature"], max_tokens, response_format)
+        key = prompt_key(*settings, system_prompt, user_prompt)
+        cached = self.prompt_cache.get(model, key)
+        if cached is not None:
+            return cached
+
+        embedding = None
+        if self.semantic_prompt_cache is not None:
+            # Only the free text is embedded; the tool arguments and output format must match exactly
+            namespace = prompt_key(*settings, system_prompt, args)
+            embedding = await self._embed(text)
+            cached = await asyncio.to_thread(self.semantic_prompt_cache.lookup, namespace, embedding)
+            if cached is not None:
+                self.prompt_cache.put(model, key, cached)
+                return cached
+
+        options = {"response_format": response_format} if response_format else {}
+        content = await self._request_completion(self._request_body(system_prompt, user_prompt, model, max_tokens, **options))
+        self.prompt_cache.put(model, key, content)
+        if embedding is not None:
+            await asyncio.to_thread(self.semantic_prompt_cache.insert, namespace, text, embedding, content)
+        return content
+
+    async def _request_completion(self, body: Dict[str, Any]) -> str:
+        if _async_batch.get():
+            return await self.batch_dispatcher.complete(body)
+        async with rate_limiter.limit(estimate_tokens(body["messages"], body["max_tokens"])):
+            response = await self.client.chat.completions.create(**body)
         return response.choices[0].message.content
 
+    async def _stream_completion(self, system_prompt: str, user_prompt: str, tool: Optional[str] = None) -> AsyncIterator[str]:
+        """Yield completion text as it is generated, caching the full text once done."""
+        model = self._model_for(tool)
+        max_tokens = self.settings["maxTokens"]
+        user_prompt = self._fit(system_prompt, user_prompt, model, max_tokens)
+        key = prompt_key(model, self.settings["temperature"], max_tokens, system_prompt, user_prompt)
+        cached = self.prompt_cache.get(model, key)
+        if cached is not None:
+            yield cached
+            return
+
+        body = self._request_body(system_prompt, user_prompt, model, max_tokens, stream=True)
+        parts = []
+        async with rate_limiter.limit(estimate_tokens(body["messages"], max_tokens)):
+            response = await self.client.chat.completions.create(**body)
+            async for chunk in response:
+                if chunk.choices and (delta := chunk.choices[0].delta.content):
+                    parts.append(delta)
+                    yield delta
+        self.prompt_cache.put(model, key, "".join(parts))
+
+    async def _stream_items(self, tool: str, system_prompt: str, text: str, separator: str) -> AsyncIterator[str]:
+        """Yield each separator-delimited item of a streamed completion as soon as it is complete."""
+        buffer = ""
+        async for delta in self._stream_completion(system_prompt, text, tool):
+            buffer += delta
+            *items, buffer = buffer.split(separator)
+            for item in items:
+                if item := item.strip():
+                    yield item
+        if item := buffer.strip():
+            yield item
+
+    def stream_entities(self, text: str) -> AsyncIterator[str]:
+        """Yield named entities one at a time while the completion is still generating."""
+        return self._stream_items("entities", SYSTEM_PROMPTS["entities_lines"], text, "\n")
+
+    def stream_questions(self, text: str) -> AsyncIterator[str]:
+        """Yield generated questions one at a time while the completion is still generating."""
+        return self._stream_items("questions", SYSTEM_PROMPTS["questions_lines"], text, "\n")
+
+    def stream_keywords(self, text: str) -> AsyncIterator[str]:
+        """Yield keywords one at a time while the completion is still generating."""
+        return self._stream_items("keywords", SYSTEM_PROMPTS["keywords_list"], text, ",")
+
+    async def _create_structured(self, tool: str, user_prompt: str, args: Optional[Dict[str, str]] = None) -> Dict[str, Any]:
+        """Create a completion constrained to the tool's JSON schema and return the parsed object."""
+        system_prompt = SYSTEM_PROMPTS[tool]
+        if supports_json_schema(self._model_for(tool)):
+            response_format = {
+                "type": "json_schema",
+                "json_schema": {"name": tool, "schema": JSON_SCHEMAS[tool], "strict": True}
+            }
+        else:
+            # JSON mode only guarantees valid JSON, so the schema is spelled out in the (still static) prompt
+            response_format = {"type": "json_object"}
+            system_prompt += f" Respond with a JSON object matching this JSON schema: {json.dumps(JSON_SCHEMAS[tool])}"
+        content = await self._create_completion(system_prompt, user_prompt, response_format, tool=tool, args=args)
+        if content is None:
+            # A refusal comes back with no content
+            logger.warning("Structured %s output was refused", tool)
+            return {}
+        try:
+            result = orjson.loads(content)
+        except orjson.JSONDecodeError:
+            # Output cut off by max_tokens
+            logger.warning("Structured %s output was not valid JSON", tool)
+            return {}
+        return result if isinstance(result, dict) else {}
+
+    @staticmethod
+    def _bulk_system_prompt(instruction: str, count: int) -> str:
+        return (
+            f"{instruction} You will receive {count} numbered texts. "
+            f"Respond with only a JSON array of exactly {count} results, in the same order as the texts."
+        )
+
+    async def _create_bulk_completion(self, tool: str, instruction: str, texts: List[str], tokens_per_text: int) -> List[Any]:
+        """Answer one instruction for many texts, returning one result per text.
+
+        Texts are packed into as few completions as fit the context window; each text is
+        truncated on its own if it cannot fit even alone, so no text is ever dropped.
+        """
+        if not texts:
+            return []
+        model = self._model_for(tool)
+        enc = encoding_for(model)
+        context_tokens, output_tokens = model_limits(model)
+        # Each group's completion budget grows with its size and must stay under the model's output limit
+        max_group = max(1, output_tokens // tokens_per_text)
+        available = context_tokens - 2 * PROMPT_OVERHEAD_TOKENS
+        available -= len(enc.encode(self._bulk_system_prompt(instruction, len(texts))))
+        text_limit = available - tokens_per_text - BULK_ITEM_OVERHEAD_TOKENS
+        if text_limit <= 0:
+            raise ValueError(f"No room for input with {tokens_per_text} completion tokens per text")
+
+        groups: List[List[str]] = [[]]
+        used = 0
+        for text in texts:
+            ids = enc.encode(text)
+            if len(ids) > text_limit:
+                logger.debug("Truncating bulk input from %d to %d tokens", len(ids), text_limit)
+                text, ids = enc.decode(ids[:text_limit]), ids[:text_limit]
+            cost = len(ids) + tokens_per_text + BULK_ITEM_OVERHEAD_TOKENS
+            if groups[-1] and (used + cost > available or len(groups[-1]) >= max_group):
+                groups.append([])
+                used = 0
+            groups[-1].append(text)
+            used += cost
+
+        results = await asyncio.gather(*(
+            self._create_bulk_group(tool, instruction, group, tokens_per_text) for group in groups
+        ))
+        return [result for group in results for result in group]
+
+    async def _create_bulk_group(self, tool: str, instruction: str, texts: List[str], tokens_per_text: int) -> List[Any]:
+        system_prompt = self._bulk_system_prompt(instruction, len(texts))
+        user_prompt = "\n\n".join(f"{i}) {text}" for i, text in enumerate(texts, start=1))
+        content = await self._create_completion(
+            system_prompt, user_prompt, max_tokens=tokens_per_text * len(texts), tool=tool
+        )
+        if content is None:
+            # A refusal comes back with no content
+            raise ValueError(f"Bulk {tool} request was refused")
+        content = content.strip()
+        # Models sometimes wrap JSON in a markdown fence
+        if content.startswith("```"):
+            content = content.strip("`").removeprefix("json").strip()
+        results = json.loads(content)
+        if not isinstance(results, list) or len(results) != len(texts):
+            raise ValueError(f"Expected {len(texts)} results, got {len(results) if isinstance(results, list) else type(results).__name__}")
+        return results
+
+    async def classify_text_bulk(self, texts: List[str], categories: List[str] = None) -> List[Dict[str, str]]:
+        """Classify many texts with one request."""
+        categories_str = ", ".join(categories or ["General", "Technical", "Business", "Creative"])
+        results = await self._create_bulk_completion(
+            "classify",
+            f"Classify each text into one of these categories: {categories_str}. Each result is a string naming the category with a one-sentence reason.",
+            texts, 100
+        )
+        return [{"classification": str(result)} for result in results]
+
+    async def summarize_text_bulk(self, texts: List[str]) -> List[Dict[str, str]]:
+        """Summarize many texts with one request."""
+        results = await self._create_bulk_completion(
+            "summarize",
+            "Provide a concise summary of each text, focusing on key points and main ideas. Each result is a string.",
+            texts, 200
+        )
+        return [{"summary": str(result)} for result in results]
+
+    async def extract_keywords_bulk(self, texts: List[str]) -> List[Dict[str, List[str]]]:
+        """Extract keywords from many texts with one request."""
+        results = await self._create_bulk_completion(
+            "keywords",
+            "Extract key terms and phrases from each text, focusing on important concepts and technical terms. Each result is an array of strings.",
+            texts, 100
+        )
+        return [{"keywords": _strings(result)} for result in results]
+
+    async def extract_entities_bulk(self, texts: List[str]) -> List[Dict[str, List[str]]]:
+        """Extract named entities from many texts with one request."""
+        results = await self._create_bulk_completion(
+            "entities",
+            'Extract named entities (people, places, organizations) from each text. Each result is an array of strings like "Person: John Smith".',
+            texts, 150
+        )
+        return [{"entities": _strings(result)} for result in results]
+
     def _register_tools(self):
         """Register all available tools."""
         @self.registry.register("analyze", "Analyze text for sentiment, tone, and key points")
-        def analyze_text(text: str) -> Dict[str, Any]:
-            system_prompt = "Analyze the following text for sentiment, tone, and key points. Format your response with clear sections."
-            return {"analysis": self._create_completion(system_prompt, text)}
+        async def analyze_text(text: str) -> Dict[str, Any]:
+            return {"analysis": await self._create_completion(SYSTEM_PROMPTS["analyze"], text, tool="analyze")}
 
         @self.registry.register("translate", "Translate text to target language")
-        def translate_text(text: str, target_language: str = "English") -> Dict[str, str]:
-            system_prompt = f"Translate the following text to {target_language}. Maintain the original formatting and style."
-            return {"translation": self._create_completion(system_prompt, text)}
+        async def translate_text(text: str, target_language: str = "English") -> Dict[str, str]:
+            args = {"Target language": target_language}
+            return {"translation": await self._create_completion(SYSTEM_PROMPTS["translate"], text, tool="translate", args=args)}
 
         @self.registry.register("summarize", "Generate a concise summary of text")
-        def summarize_text(text: str) -> Dict[str, str]:
-            system_prompt = "Provide a concise summary of the following text. Focus on key points and main ideas."
-            return {"summary": self._create_completion(system_prompt, text)}
+        async def summarize_text(text: str) -> Dict[str, str]:
+            return {"summary": await self._create_completion(SYSTEM_PROMPTS["summarize"], text)}
 
         @self.registry.register("classify", "Classify text into categories")
-        def classify_text(text: str, categories: List[str] = None) -> Dict[str, str]:
+        async def classify_text(text: str, categories: List[str] = None) -> Dict[str, str]:
             if not categories:
                 categories = ["General", "Technical", "Business", "Creative"]
-            categories_str = ", ".join(categories)
-            system_prompt = f"Classify the following text into one of these categories: {categories_str}. Explain your reasoning."
-            return {"classification": self._create_completion(system_prompt, text)}
+            result = await self._create_structured("classify", text, args={"Categories": ", ".join(categories)})
+            return {"classification": f"{result.get('category', 'Unknown')}: {result.get('reasoning', 'No reasoning given.')}"}
 
         @self.registry.register("questions", "Generate questions about text")
-        def generate_questions(text: str) -> Dict[str, List[str]]:
-            system_prompt = "Generate 3-5 relevant questions about the following text. Make them thought-provoking and specific."
-            questions = self._create_completion(system_prompt, text).split('\n')
-            return {"questions": [q.strip() for q in questions if q.strip()]}
+        async def generate_questions(text: str) -> Dict[str, List[str]]:
+            result = await self._create_structured("questions", text)
+            return {"questions": _strings(result.get("questions"))}
 
         @self.registry.register("keywords", "Extract key terms and phrases")
-        def extract_keywords(text: str) -> Dict[str, List[str]]:
-            system_prompt = "Extract key terms and phrases from the following text. Focus on important concepts and technical terms."
-            keywords = self._create_completion(system_prompt, text).split(',')
-            return {"keywords": [k.strip() for k in keywords if k.strip()]}
+        async def extract_keywords(text: str) -> Dict[str, List[str]]:
+            result = await self._create_structured("keywords", text)
+            return {"keywords": list(dict.fromkeys(_strings(result.get("keywords"))))}
+
+        @self.registry.register("bundle", "Analyze, summarize, extract keywords and generate questions in one request")
+        async def analyze_bundle(text: str) -> Dict[str, Any]:
+            # One copy of the text and one round trip instead of four separate tool calls
+            result = await self._create_structured("bundle", text)
+            return {
+                "analysis": result.get("analysis", ""),
+                "summary": result.get("summary", ""),
+                "keywords": _strings(result.get("keywords")),
+                "questions": _strings(result.get("questions"))
+            }
 
         @self.registry.register("code", "Generate code based on description")
-        def generate_code(description: str, language: str = "Python") -> Dict[str, str]:
-            system_prompt = f"""Generate {language} code based on the following description. 
-            Include:
-            1. Proper code formatting with markdown
-            2. Comments explaining the code
-            3. Error handling where appropriate
-            4. Example usage if relevant"""
-            return {"code": self._create_completion(system_prompt, description)}
+        async def generate_code(description: str, language: str = "Python") -> Dict[str, str]:
+            return {"code": await self._create_completion(SYSTEM_PROMPTS["code"], description, args={"Language": language})}
 
         @self.registry.register("entities", "Extract named entities from text")
-        def extract_entities(text: str) -> Dict[str, List[str]]:
-            system_prompt = """Extract named entities (people, places, organizations) from the following text.
-            Format each entity with its type (e.g., "Person: John Smith", "Organization: Acme Corp")."""
-            entities = self._create_completion(system_prompt, text).split('\n')
-            return {"entities": [e.strip() for e in entities if e.strip()]}
+        async def extract_entities(text: str) -> Dict[str, List[str]]:
+            result = await self._create_structured("entities", text)
+            entities = result.get("entities")
+            if not isinstance(entities, list):
+                return {"entities": []}
+            return {"entities": [
+                f"{item['type']}: {item['value']}" for item in entities
+                if isinstance(item, dict) and item.get("type") and item.get("value")
+            ]}
 
     def extract_command(self, text: str) -> Optional[str]:
         """Extract command from text if present."""
         if text.startswith('/'):
-            command = text[1:].split()[0].lower()
-            if command in self.registry.tools:
+            parts = text[1:].split(maxsplit=1)
+            if parts and (command := parts[0].lower()) in self.registry.tools:
                 return command
         return None
 
     async def execute_command(self, command: str, text: str) -> Dict[str, Any]:
         """Execute a command with the given text."""
         if command in self.registry.tools:
-            return self.registry.tools[command](text)
+            return await self.registry.tools[command](text)
         return {"error": f"Invalid command: {command}. Use /help to see available commands."}
 
+    async def run_batch(self, items: List[Tuple[str, str]], async_batch: bool = False) -> List[Dict[str, Any]]:
+        """Execute several (command, text) pairs concurrently, returning results in order.
+
+        With async_batch=True the completions go through the OpenAI Batch API as one job.
+        """
+        async def run_one(command: str, text: str) -> Dict[str, Any]:
+            # Retries are handled by the client; a request that still fails only fails its own item
+            try:
+                return await self.execute_command(command, text)
+            except openai.OpenAIError as e:
+                logger.warning("Batch item %s failed: %s", command, e)
+                return {"error": f"Error executing {command}: {e}"}
+
+        token = _async_batch.set(async_batch)
+        try:
+            return await asyncio.gather(*(run_one(command, text) for command, text in items))
+        finally:
+            _async_batch.reset(token)
+
     def get_available_tools(self) -> Dict[str, str]:
         """Get list of available tools and their descriptions."""
         return self.registry.descriptions 
\ No newline at end of file